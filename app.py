@@ -1,26 +1,58 @@
-from dash import Dash, html, dcc, Input, Output, callback, State
+from dash import Dash, html, dcc, Input, Output, callback, State, ctx, MATCH
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import json
+import logging
 import os
 import numpy as np
 from io import StringIO
-from picture_text.picture_text import PictureText
-from picture_text.src.treemap import build_sunburst, build_tree_map
+from picture_text.src.app_data import load_collection, collection_nbytes, treemap_width, test
+from picture_text.src.collection_manager import CollectionManager
+from picture_text.src.treemap import build_drilldown_tree_map
+from picture_text.src.figure_cache import FigureCache, use_orjson
+from picture_text.src.linkage import parse_memory
 from picture_text.src.explainers import ABOUT, SAMPLE_DETAILS
 from picture_text.src.feedback_form import contact_form
 import dash_bootstrap_components as dbc
-import smtplib, ssl
+from picture_text.src.mailer import Mailer
+from picture_text.src.server_metrics import instrument, timed_loader
+from functools import lru_cache
 
-model = 'gpt4'
-extract_schema = 'summary_entity1'
-emb_model_name = 'oAI-3s'
-root_path = os.environ.get('VST_SAMPLE_DATA','./sample_data')
-treemap_width = 400
-test = int(os.environ.get("VST_TEST",100))
+logging.basicConfig(level=os.environ.get('VST_LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 #app = Dash(__name__)
 app = Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
 server = app.server
+# Callback latencies and response sizes, served at /metrics
+instrument(app)
+
+# Cards are rendered a page at a time, full texts only when "Read full" is pressed
+PAGE_SIZES = [25, 50, 100]
+# Treemaps of collections with more nodes than this are sent two levels at a time, the server sends
+# the subtree of a node when it is clicked, with at most VST_DRILLDOWN_MAX_NODES nodes per figure
+DRILLDOWN_NODES = int(os.environ.get('VST_DRILLDOWN_NODES', 500))
+DRILLDOWN_MAX_NODES = int(os.environ.get('VST_DRILLDOWN_MAX_NODES', 500))
+
+def use_drilldown(collection):
+    return len(collection['df_res']) > DRILLDOWN_NODES
+
+def drilldown_figure(collection, root, width = treemap_width):
+    fig = build_drilldown_tree_map(collection['df_res'], collection['tree_index'], root=root, depth=2,
+                                   max_nodes=DRILLDOWN_MAX_NODES)
+    fig.update_layout(height = int(width*1.5), width = width)
+    return fig
+
+# Figures are converted to plain dicts once per collection build, map type, width and drill-down root,
+# Dash encodes them into each response with orjson when installed
+use_orjson()
+figure_cache = FigureCache(max_size=int(os.environ.get('VST_FIGURE_CACHE', 256)))
+
+def get_figure(collection_name, map_type, root = 'Full', width = treemap_width):
+    collection = all_data.get(collection_name)
+    key = (collection_name, collection['build_id'], map_type, width, root)
+    if map_type == 'treemap' and use_drilldown(collection):
+        return figure_cache.get(key, lambda: drilldown_figure(collection, root, width=width))
+    return figure_cache.get(key, lambda: collection[map_type])
 
 def create_analysis_view(collection_name, trm_fig):
     """This is the view screen of each page. 
@@ -38,7 +70,13 @@ def create_analysis_view(collection_name, trm_fig):
             [
                 dbc.Col(
                     dbc.Container(
-                        children=[dbc.Spinner(
+                        children=[
+                        dbc.Row([
+                            dbc.Col(dbc.Pagination(id='cards-page', max_value=1, active_page=1, fully_expanded=False)),
+                            dbc.Col(dbc.Select(id='cards-page-size', value=str(PAGE_SIZES[1]),
+                                        options=[{'label': f'{s} per page', 'value': str(s)} for s in PAGE_SIZES]), width=3),
+                        ]),
+                        dbc.Spinner(
                         children = [html.Div(
                             id='ls_cards',
                     )],
@@ -50,6 +88,7 @@ def create_analysis_view(collection_name, trm_fig):
                             id = 'treemap',
                             figure = trm_fig
                         ),
+                        dcc.Store(id='treemap-root', data='Full'),
                         contact_form(width=treemap_width),
                         ]
                         +([html.P(id='out')] if test > 0 else []),
@@ -60,60 +99,13 @@ def create_analysis_view(collection_name, trm_fig):
     ])
 
 
-def prep_data(collection_name, width = treemap_width):
-    save_to = os.path.join(root_path,f'topic_n_ent_{collection_name}_{model}_{extract_schema}_{emb_model_name}.json')
-    
-    text_data = json.load(open(save_to,'r'))
-
-    if test > 0:
-        text_data = text_data[:test]
-
-    txt_embeddings = [td['embedding'] for td in text_data]
-    txt = [f"{td['topic_tag']}" for td in text_data]
-    txt_file = [f"{td['file']}" for td in text_data]
-    tag_to_file = {txt[i]:txt_file[i] for i in range(len(txt))}
-    pt = PictureText(txt)
-    pt(txt_embeddings=txt_embeddings,encoder=None,hac_method='ward', hac_metric='euclidean')
-    df_res = pt.hac_to_treemap(pt.linkage_table, 
-                   depth=4, 
-                   nr_splits=3, 
-                   min_size=0.1,
-                   max_extension=1,)
-    df_res['labels'], df_res['score']= zip(*df_res.apply(lambda x: \
-            pt.cluster_summary_simple([np.array(txt[m]) for m in x['cluster_members']], \
-                                [np.array(txt_embeddings[m]) for m in x['cluster_members']]), axis=1))
-    df_res['tag_file'] = df_res['labels'].apply(lambda x: tag_to_file.get(x,x))
-    color_discrete_map={'(?)':'black'}
-    nickname_colors = {
-        "392_bach": "gold", "398_zuck": "blue", "darkblue": "Musk", "405_bezos": "grey",
-        "416_lecun": "orange", "419_sama": "red", "ADSK_Q4": "gold", "BBY_Q4": "blue",
-        "BUD_Q4": "darkblue", "CRM_Q4": "grey", "DOCU_Q4": "orange", "JWN_Q4": "green",
-        "KR_Q4": "red", "SNOW_Q4": "purple",
-    }
-    color_discrete_map={**color_discrete_map, **nickname_colors}
-    df_res['tag_color'] = df_res['tag_file'].apply(lambda x: color_discrete_map.get(x,'grey'))
-
-    trm_fig = build_tree_map(df_res)
-    trm_fig.update_layout(height = int(width*1.5), width = width)
-    sun_fig = build_sunburst(df_res)
-    sun_fig.update_layout(height = int(width*1.5), width = width)
-    try:
-        save_csv = os.path.join(root_path,f'df_res_{collection_name}_{model}_{extract_schema}_{emb_model_name}.csv')
-        df_res.to_csv(save_csv)
-    except: 
-        pass
-    del txt_embeddings
-    del txt
-    for e in text_data:
-        del e['embedding']
-    print('Finished prepping', collection_name, ':::', len(text_data),text_data[0].keys())
-    return {
-        "df_res": df_res, 
-        "sunburst": sun_fig,
-        "treemap": trm_fig, 
-        "text_data": text_data}
-
-all_data = {topic: prep_data(topic) for topic in SAMPLE_DETAILS.keys()}
+# Collections are built offline (python -m picture_text.src.app_data), memory-mapped when first requested
+# and the least recently used ones are dropped above VST_COLLECTIONS_MEMORY, together with their cached figures
+all_data = CollectionManager(timed_loader(load_collection), max_bytes=parse_memory(os.environ.get('VST_COLLECTIONS_MEMORY','1GB')),
+                             sizeof=collection_nbytes, on_evict=figure_cache.drop)
+# Collections listed in VST_PRELOAD are loaded before gunicorn forks its workers, e.g. VST_PRELOAD=lex,tr8
+for topic in filter(None, os.environ.get('VST_PRELOAD','').split(',')):
+    all_data.get(topic)
 
 
 ######## NAVBAR ########
@@ -160,9 +152,9 @@ def render_page_content(pathname):
     elif pathname.endswith('treemap') or pathname.endswith('sunburst'):
         collection_name = pathname.replace('/','').split('-')[0]
         map_type = pathname.replace('/','').split('-')[1]
-        assert(collection_name in all_data.keys())
+        assert(collection_name in SAMPLE_DETAILS.keys())
         assert(map_type in ['treemap','sunburst'])
-        return create_analysis_view(collection_name, all_data[collection_name][map_type])
+        return create_analysis_view(collection_name, get_figure(collection_name, map_type))
     # If the user tries to reach a different page, return a 404 message
     return html.Div(
         [
@@ -181,10 +173,37 @@ def clean_data(pathname):
 
     if pathname == "/":
         return None, None
-    text_data = all_data[pathname.replace('/','').split('-')[0]]['text_data']
-    df_res = all_data[pathname.replace('/','').split('-')[0]]['df_res']
+    collection = all_data.get(pathname.replace('/','').split('-')[0])
+    text_data = collection['text_data']
+    df_res = collection['df_res']
     return text_data, df_res.to_json(date_format='iso', orient='split')"""
 
+######## CALLBACK: DRILL DOWN ########
+@callback(
+    [Output("treemap", "figure"),
+     Output("treemap-root", "data")],
+    Input("treemap", "clickData"),
+    [State("treemap-root", "data"),
+     State("url", "pathname")],
+    prevent_initial_call=True)
+def drill_down(selected_data, root, pathname):
+    collection_name, map_type = pathname.replace('/','').split('-')[:2]
+    collection = all_data.get(collection_name)
+    if map_type != 'treemap' or not use_drilldown(collection):
+        raise PreventUpdate
+    if selected_data is None or not 'id' in selected_data['points'][0]:
+        raise PreventUpdate
+    index = collection['tree_index']
+    select_id = str(selected_data['points'][0]['id'])
+    if select_id == root:
+        # Clicking the current root goes one level up
+        new_root = str(collection['df_res']['parent'].iloc[index['position'][root]]) if root in index['position'] else 'Full'
+    elif select_id in index['children']:
+        new_root = select_id
+    else:
+        raise PreventUpdate
+    return get_figure(collection_name, map_type, root=new_root), new_root
+
 ######## CALLBACK: TRACK SELECTION ########
 @callback(
     Output("out", "children"),
@@ -196,84 +215,122 @@ def first_callback(selected_data):
         return json.dumps(selected_data)
 
 def list_ents(item):
-    #[t['named_entity'] for t in text_data[mmb_id]['mentioned_entities']]
-    ent_list = eval(item['mentioned_entities'])
+    # Entity names are parsed when the collection is built, see app_data.parse_entities
+    ent_list = item.get('entities', [])
     if len(ent_list) == 0:
         return []
     return [
-        dbc.Badge(f"{ent['named_entity']}", color="dark", className="me-1")
+        dbc.Badge(f"{ent}", color="dark", className="me-1")
         for ent in ent_list
     ]
 
+# Rendered cards are reused across clicks and pages, keyed by the build id so a rebuilt collection
+# reloaded after eviction does not serve cards of the old build
+@lru_cache(maxsize=int(os.environ.get('VST_CARD_CACHE', 4096)))
+def cached_card(collection_name, build_id, mmb_id, collapsed):
+    item = all_data.get(collection_name)['text_data'][mmb_id]
+    return make_card(item, mmb_id, collapsed)
+
+def make_card(item, mmb_id, collapsed):
+    if collapsed:
+        card = dbc.Card(
+            dbc.CardHeader(f'{item["nickname"]}#{mmb_id} Heading: {item["summary_title"]}'),
+            style = {"width": "24rem", 'margin': '10px'},
+        )
+    else:
+        card = dbc.Card(
+        [
+            dbc.CardHeader(f'Item: {mmb_id} Heading: ' + item['summary_title']),
+            dbc.CardHeader('Tag: ' + item['topic_tag']),
+            dbc.CardBody(
+                dbc.ListGroup(
+                    [dbc.ListGroupItem(b) for b in item["summary_bullets"].split('\n')]
+                ),
+            ),
+            dbc.CardFooter('Source: ' + item['nickname']),
+            dbc.CardFooter(list_ents(item)),
+            dbc.Button(f"Read full ({len(item['topic_text'].split())} words)",
+                        color="dark", id={'type': 'read-full', 'index': mmb_id}),
+            dbc.Popover(
+                [
+                    dbc.PopoverHeader(item['summary_title']),
+                    # Filled by show_full_text when the button is pressed
+                    dbc.PopoverBody(id={'type': 'full-text', 'index': mmb_id}),
+                ],
+                target={'type': 'read-full', 'index': mmb_id},
+                placement="bottom-end",
+                trigger="click",
+                style={"maxWidth": "80%"},
+            ),
+        ],
+        style = {"width": "24rem", 'margin': '10px'},
+    )
+    return card
+
 ######## CALLBACK: SHOW CARDS ########
 @callback(
-    Output("ls_cards", "children"),
+    [Output("ls_cards", "children"),
+     Output("cards-page", "max_value"),
+     Output("cards-page", "active_page")],
     [Input("treemap", "clickData"),
      #Input('intermediate-text-data', 'data'),
      #Input('intermediate-df-res', 'data'),
      Input("url", "pathname"),
-     Input("collapse-all-button", "n_clicks")],)
-def show_cards(selected_data, pathname, nr_clicks):
-    cluster_members = []
+     Input("collapse-all-button", "n_clicks"),
+     Input("cards-page", "active_page"),
+     Input("cards-page-size", "value")],)
+def show_cards(selected_data, pathname, nr_clicks, page, page_size):
     current_path = 'Full/'
-    text_data = all_data[pathname.replace('/','').split('-')[0]]['text_data']
-    df_res = all_data[pathname.replace('/','').split('-')[0]]['df_res']
+    collection_name = pathname.replace('/','').split('-')[0]
+    collection = all_data.get(collection_name)
+    text_data = collection['text_data']
     #if text_data is None or jsonified_cleaned_data is None:
     #    list_cards = []
     #df_res = pd.read_json(StringIO(jsonified_cleaned_data), orient='split')
-    if selected_data is None:
-        cluster_members = list(range(min(50,df_res.shape[0])))
-    elif not 'id' in selected_data['points'][0]:
-        cluster_members = list(range(min(50,df_res.shape[0])))
+    if selected_data is None or not 'id' in selected_data['points'][0]:
+        cluster_members = range(len(text_data))
     else:
-        select_id = selected_data['points'][0]['id']
-        current_path = selected_data['points'][0]['currentPath'] + selected_data['points'][0]['label']
-        cluster_members = df_res[df_res['id'] == select_id]\
-            .to_dict(orient='records')[0]['cluster_members']
-    def make_card(mmb_id, nr_clicks):
-        if nr_clicks % 2:
-            card = dbc.Card(
-                dbc.CardHeader(f'{text_data[mmb_id]["nickname"]}#{mmb_id} Heading: {text_data[mmb_id]["summary_title"]}'),
-                style = {"width": "24rem", 'margin': '10px'},
-            )
-        else:
-            card = dbc.Card(
-            [
-                dbc.CardHeader(f'Item: {mmb_id} Heading: ' + text_data[mmb_id]['summary_title']),
-                dbc.CardHeader('Tag: ' + text_data[mmb_id]['topic_tag']),
-                dbc.CardBody(
-                    dbc.ListGroup(
-                        [dbc.ListGroupItem(b) for b in text_data[mmb_id]["summary_bullets"].split('\n')]
-                    ),
-                ),
-                dbc.CardFooter('Source: ' + text_data[mmb_id]['nickname']),
-                dbc.CardFooter(list_ents(text_data[mmb_id])),
-                dbc.Button(f"Read full ({len(text_data[mmb_id]['topic_text'].split())} words)", 
-                            color="dark", id=f"btn-{mmb_id}"),
-                dbc.Popover(
-                    [
-                        dbc.PopoverHeader(text_data[mmb_id]['summary_title']),
-                        dbc.PopoverBody(text_data[mmb_id]['topic_text']),
-                    ],
-                    target=f"btn-{mmb_id}",
-                    placement="bottom-end",
-                    trigger="click",
-                    style={"maxWidth": "80%"},
-                ),
-            ],
-            style = {"width": "24rem", 'margin': '10px'},
-        )
-        return card
+        point = selected_data['points'][0]
+        cluster_members = collection['node_index'].get(str(point['id']))
+        # Ids of another collection (stale clickData after switching) or made up ones
+        if cluster_members is None:
+            raise PreventUpdate
+        current_path = point.get('currentPath', '') + str(point.get('label', ''))
+    # A new selection or page size starts from the first page
+    if ctx.triggered_id in ['treemap', 'url', 'cards-page-size'] or not page:
+        page = 1
+    page_size = int(page_size or PAGE_SIZES[1])
+    nr_pages = max(1, -(-len(cluster_members) // page_size))
+    page = min(page, nr_pages)
     list_cards = [
-        make_card(mmb_id,nr_clicks)
-        for mmb_id in cluster_members
+        cached_card(collection_name, collection['build_id'], int(mmb_id), bool(nr_clicks % 2))
+        for mmb_id in cluster_members[(page - 1) * page_size:page * page_size]
     ]
     return [
-        html.P(children=f'Showing: {len(cluster_members)} items, current path {current_path}'),
+        html.P(children=f'Showing: {len(list_cards)} of {len(cluster_members)} items, page {page} of {nr_pages}, current path {current_path}'),
         dbc.Row(list_cards, justify="evenly",)
-    ]
+    ], nr_pages, page
+
+######## CALLBACK: READ FULL TEXT ########
+@callback(
+    Output({'type': 'full-text', 'index': MATCH}, 'children'),
+    Input({'type': 'read-full', 'index': MATCH}, 'n_clicks'),
+    State("url", "pathname"),
+    prevent_initial_call=True)
+def show_full_text(n, pathname):
+    collection = all_data.get(pathname.replace('/','').split('-')[0])
+    return collection['text_data'].field(ctx.triggered_id['index'], 'topic_text')
 
 ######## CALLBACK: SEND EMAIL ########
+if os.path.exists('email.key'):
+    with open('email.key','r') as f:
+        receiver_email, receiver_pass = [l.strip() for l in f.readlines()]
+else:
+    receiver_email = os.environ.get('VST_EMAIL','<your email address here>')
+    receiver_pass = os.environ.get('VST_PASS','<your email password here>')
+# Messages are persisted in VST_OUTBOX until sent, so they survive restarts
+mailer = Mailer("smtp.gmail.com", 465, receiver_email, receiver_pass, outbox=os.environ.get('VST_OUTBOX','./outbox'))
+
 @app.callback(Output('div-button', 'children'),
      Input("button-submit", 'n_clicks'),
      Input("example-email-row", 'value'),
@@ -281,15 +338,6 @@ def show_cards(selected_data, pathname, nr_clicks):
      Input("example-message-row", 'value')
     )
 def submit_message(n, email, name, message):
-    if os.path.exists('email.key'):
-        with open('email.key','r') as f:
-            receiver_email, receiver_pass = f.readlines()
-    else:
-        receiver_email = os.environ.get('VST_EMAIL','<your email address here>')
-        receiver_pass = os.environ.get('VST_PASS','<your email password here>')
-    port = 465  # For SSL
-    # Create a secure SSL context
-    context = ssl.create_default_context()       
     msg = f'''\
 From: {email}
 Subject: Feedback: {name}
@@ -306,11 +354,11 @@ MESSAGE:
         if (email is None) or (name is None) or (message is None):
             return [dbc.Alert("Please fill in all fields", color="secondary"),
                     dbc.Button('Submit', color = 'dark', id='button-submit', n_clicks=0)]
-        with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
-            server.login(receiver_email, receiver_pass)
-            server.sendmail(email, receiver_email, msg)
-            server.quit()
-        return [html.P("Message Sent")]
+        # Delivered in the background, the callback does not wait for the SMTP server
+        if not mailer.send(email, msg):
+            return [dbc.Alert("Too many messages right now, please try again later", color="secondary"),
+                    dbc.Button('Submit', color = 'dark', id='button-submit', n_clicks=0)]
+        return [html.P("Message queued for delivery")]
     else:
         return [dbc.Button('Submit', color = 'dark', id='button-submit', n_clicks=0)]
 
@@ -0,0 +1,218 @@
+"""
+Benchmarks the PictureText pipeline stage by stage on synthetic embedding corpora.
+
+Each (N, dimension) configuration runs in a fresh process so peak RSS is not inherited from earlier runs.
+Stages timed separately:
+    - encode: a stub encoder looking up precomputed vectors
+    - linkage: HAC in PictureText.__call__ (fastcluster, engine chosen by memory budget)
+    - hac: HACTree construction from the linkage table
+    - treemap: PictureText.hac_to_treemap
+    - summarize: default centroid summaries of all treemap nodes, as in make_picture
+    - figure: build_tree_map
+
+Usage:
+    python benchmarks/bench_pipeline.py --sizes 1000,10000,50000 --dims 64,384 --out results.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json --threshold 0.25
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import resource
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+STAGES = ['encode', 'linkage', 'hac', 'treemap', 'summarize', 'figure']
+
+def synthetic_corpus(n, dim, nr_topics=50, seed=0):
+    """
+    Gaussian topic clusters of unit-scale noise around random centres, float32 like real sentence embeddings
+    """
+    rng = np.random.RandomState(seed)
+    centres = rng.normal(0, 3, (nr_topics, dim))
+    topics = rng.randint(0, nr_topics, n)
+    X = (centres[topics] + rng.normal(0, 1, (n, dim))).astype(np.float32)
+    return [f'document {i} about topic {t}' for i, t in enumerate(topics)], X
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def run_config(n, dim, depth, memory_budget):
+    """
+    Runs all stages for one configuration, returns one result per stage
+    """
+    from picture_text.picture_text import PictureText
+    from picture_text.src.hac_tools import HACTree
+    from picture_text.src.summarizers import TreeNodes, centroid_summarizer, run_summarizer
+    from picture_text.src.treemap import build_tree_map
+
+    txt, X = synthetic_corpus(n, dim)
+    lookup = {t: i for i, t in enumerate(txt)}
+    stub_encoder = lambda text_list: X[[lookup[t] for t in text_list]]
+    pt = PictureText(txt)
+    res = []
+    def timed(stage, func):
+        t0 = time.perf_counter()
+        out = func()
+        res.append({'n': n, 'dim': dim, 'stage': stage, 'seconds': time.perf_counter() - t0, 'peak_rss_mb': peak_rss_mb()})
+        return out
+
+    embeddings = timed('encode', lambda: stub_encoder(txt))
+    timed('linkage', lambda: pt(embeddings, memory_budget=memory_budget))
+    tree = timed('hac', lambda: HACTree(pt.linkage_table))
+    pt.tree = tree
+    pt.layout_cache.clear(source=pt.linkage_table)
+    df_res = timed('treemap', lambda: pt.hac_to_treemap(pt.linkage_table, depth=depth))
+    nodes = TreeNodes.from_tree(pt.tree, embeddings, txt, df_res['id'])
+    labels, scores = timed('summarize', lambda: run_summarizer(centroid_summarizer, nodes))
+    df_res['labels'], df_res['color'] = labels, scores
+    timed('figure', lambda: build_tree_map(df_res))
+    for r in res:
+        r['linkage_engine'] = pt.linkage_engine
+    return res
+
+def _worker(args, queue):
+    try:
+        queue.put(run_config(*args))
+    except BaseException as e:
+        queue.put({'error': repr(e)})
+
+def run_isolated(n, dim, depth, memory_budget, timeout=None, poll=1.0):
+    """
+    Runs one configuration in a spawned process
+
+    Returns:
+        results (list): one result per stage, empty if the configuration failed
+        error (string): None, or why the configuration failed, e.g. the child was killed by the OOM killer
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_worker, args=((n, dim, depth, memory_budget), queue))
+    p.start()
+    t0 = time.perf_counter()
+    out = None
+    # A child killed by the kernel never puts anything on the queue, so poll instead of waiting forever
+    while out is None:
+        try:
+            out = queue.get(timeout=poll)
+        except Empty:
+            if not p.is_alive():
+                # The result may have been put just before exiting
+                try:
+                    out = queue.get(timeout=poll)
+                except Empty:
+                    out = {'error': f'worker died with exit code {p.exitcode}'}
+            elif timeout is not None and time.perf_counter() - t0 > timeout:
+                p.kill()
+                out = {'error': f'timed out after {timeout} secs'}
+    p.join()
+    if isinstance(out, dict):
+        print(f'  n={n} dim={dim} failed: {out["error"]}')
+        return [], out['error']
+    return out, None
+
+def compare(results, baseline, threshold=0.25, min_seconds=0.05, failures=()):
+    """
+    Compares results against baseline results of the same (n, dim, stage). Configurations that failed
+    are regressions when the baseline has results for them
+
+    Returns:
+        list of regressions, each a dictionary with the result, baseline seconds and ratio, or with the error of a failed configuration
+
+    >>> baseline = [{'n': 10, 'dim': 2, 'stage': 'linkage', 'seconds': 1.0}, {'n': 20, 'dim': 2, 'stage': 'linkage', 'seconds': 2.0}]
+    >>> [r['ratio'] for r in compare([{'n': 10, 'dim': 2, 'stage': 'linkage', 'seconds': 1.5}], baseline)]
+    [1.5]
+    >>> compare([], baseline, failures=[{'n': 20, 'dim': 2, 'error': 'worker died with exit code -9'}])
+    [{'n': 20, 'dim': 2, 'error': 'worker died with exit code -9', 'stage': 'all'}]
+    """
+    base = {(b['n'], b['dim'], b['stage']): b for b in baseline}
+    configs = {(b['n'], b['dim']) for b in baseline}
+    regressions = [{**f, 'stage': 'all'} for f in failures if (f['n'], f['dim']) in configs]
+    for r in results:
+        b = base.get((r['n'], r['dim'], r['stage']))
+        if b is None or max(r['seconds'], b['seconds']) < min_seconds:
+            continue
+        ratio = r['seconds'] / max(b['seconds'], 1e-9)
+        if ratio > 1 + threshold:
+            regressions.append({**r, 'baseline_seconds': b['seconds'], 'ratio': ratio})
+    return regressions
+
+def scaling_report(results):
+    """
+    Prints each stage's time per size and the empirical scaling exponent between consecutive sizes,
+    t ~ N^k, so the knees where a stage turns quadratic show up
+    """
+    for dim in sorted({r['dim'] for r in results}):
+        print(f'\ndim={dim}')
+        print(f'{"stage":>10} ' + ' '.join(f'{n:>12}' for n in sorted({r["n"] for r in results if r["dim"] == dim})))
+        for stage in STAGES:
+            rows = sorted([r for r in results if r['dim'] == dim and r['stage'] == stage], key=lambda r: r['n'])
+            cells = []
+            for prev, r in zip([None] + rows[:-1], rows):
+                cell = f'{r["seconds"]:.3f}s'
+                if prev is not None and prev['seconds'] > 1e-3:
+                    cell += f' k={np.log(r["seconds"] / prev["seconds"]) / np.log(r["n"] / prev["n"]):.1f}'
+                cells.append(f'{cell:>12}')
+            print(f'{stage:>10} ' + ' '.join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the PictureText pipeline stage by stage')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='comma separated corpus sizes, e.g. 1000,10000,100000,500000')
+    parser.add_argument('--dims', default='64,384', help='comma separated embedding dimensions')
+    parser.add_argument('--depth', type=int, default=6, help='hac_to_treemap depth')
+    parser.add_argument('--memory-budget', default=None, help="linkage memory budget, e.g. '16GB', defaults to the available memory")
+    parser.add_argument('--out', default='bench_results.json', help='results file')
+    parser.add_argument('--baseline', default=None, help='baseline results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown reported as a regression')
+    parser.add_argument('--save-baseline', default=None, help='also write the results to this baseline file')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a configuration is killed and counted as failed')
+    args = parser.parse_args()
+
+    results = []
+    failures = []
+    for dim in [int(d) for d in args.dims.split(',')]:
+        for n in [int(s) for s in args.sizes.split(',')]:
+            print(f'Running n={n} dim={dim}')
+            res, error = run_isolated(n, dim, args.depth, args.memory_budget, timeout=args.timeout)
+            results += res
+            if error is not None:
+                failures.append({'n': n, 'dim': dim, 'error': error})
+
+    out = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+        'failures': failures,
+    }
+    for path in filter(None, [args.out, args.save_baseline]):
+        with open(path, 'w') as f:
+            json.dump(out, f, indent=1)
+    scaling_report(results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, threshold=args.threshold, failures=failures)
+        for r in regressions:
+            if 'error' in r:
+                print(f'REGRESSION n={r["n"]} dim={r["dim"]} failed: {r["error"]}')
+            else:
+                print(f'REGRESSION {r["stage"]} n={r["n"]} dim={r["dim"]}: {r["seconds"]:.3f}s vs {r["baseline_seconds"]:.3f}s ({r["ratio"]:.2f}x)')
+        if regressions:
+            sys.exit(1)
+        print(f'\nNo regressions above {args.threshold:.0%} against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,22 @@
 import os
+import shutil
 
 bind = "0.0.0.0:8080"
-workers = os.environ.get('GUNICORN_WORKERS',4)
\ No newline at end of file
+workers = os.environ.get('GUNICORN_WORKERS',4)
+# Load the app and VST_PRELOAD collections once in the master before forking. Workers keep sharing the pages of the
+# memory-mapped arrays (embeddings, tree, text records); Python objects loaded in the master, such as the figure
+# dictionaries and the df_res node tables, are copied into each worker on write once their reference counts change
+preload_app = True
+
+# Workers write their metrics to this directory so /metrics reports all of them. Set up here, before the preloaded app
+# imports prometheus_client, and emptied so values of a previous run are not added to this one's
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/dev/shm/vst-metrics')
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
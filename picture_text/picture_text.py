@@ -1,24 +1,45 @@
+import logging
 from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
-import fastcluster
 import numpy as np
 
-from picture_text.src.hac_tools import HAC
+from picture_text.src.hac_tools import HACTree
+from picture_text.src.summarizers import TreeNodes, centroid_summarizer, is_batched, parallel_summarizer
+from picture_text.src.linkage import linkage
+from picture_text.src.approx_hac import approximate_linkage
 from picture_text.src.treemap import build_tree_map
-from picture_text.src.utils import TimeClass
+from picture_text.src.layout_cache import LayoutCache
+from picture_text.src.incremental import IncrementalLinkage
+from picture_text.src.bundle import save_bundle, load_bundle
+from picture_text.src.metrics import Metrics
+from picture_text.src.encoders import get_sentence_transformer, get_parallel_encoder, encode_stream, bucketed_encode
 
-def sbert_encoder(text_list, pretrained_reference='distilbert-base-nli-stsb-mean-tokens'):
+logger = logging.getLogger(__name__)
+
+def sbert_encoder(text_list, pretrained_reference='distilbert-base-nli-stsb-mean-tokens', device=None, processes=None,
+                    token_budget=None, stats=None):
     """
-    Helper function using sentence_transformers which simplifies the embedding call
+    Helper function using sentence_transformers which simplifies the embedding call.
+    Models are kept warm in a process-wide cache (see picture_text.src.encoders.model_cache),
+    so only the first call for a given pretrained_reference and device pays the model load
 
     Args:
         text_list (list): list of strings to embed
         pretrained_reference (string, optional): the pretrained model to use inside SentenceTransformer, refer to https://www.sbert.net, defaults to 'distilbert-base-nli-stsb-mean-tokens'
+        device (string, optional): device to run the model on, e.g. 'cpu' or 'cuda', defaults to None which lets sentence_transformers decide
+        processes (int, optional): when above 1, texts are sharded across a pool of this many worker processes (see ParallelEncoder), defaults to None
+        token_budget (int, optional): when set, texts are encoded in length-sorted batches of at most this many padded tokens instead of fixed batches of 16 (see bucketed_encode), per worker shard with processes, defaults to None
+        stats (BatchStats, optional): records padding efficiency and throughput of bucketed encoding, not available with processes, defaults to None
     Returns:
         list of embeddings for each string
     """
-    from sentence_transformers import SentenceTransformer
-    model = SentenceTransformer(pretrained_reference)
+    if processes and processes > 1:
+        if stats is not None:
+            raise ValueError('stats are recorded in the calling process only, they cannot be used with processes')
+        return get_parallel_encoder(pretrained_reference, processes, device=device, token_budget=token_budget)(text_list)
+    model = get_sentence_transformer(pretrained_reference, device=device)
+    if token_budget:
+        return bucketed_encode(text_list, model, token_budget=token_budget, stats=stats)
     text_embeddings = model.encode(text_list, batch_size=16, show_progress_bar=False, convert_to_numpy=True)
     return text_embeddings
 
@@ -26,12 +47,14 @@ class PictureText(object):
     """
     PictureText class for the build of treemaps from hierarchical clustering of text embeddings
     """
-    def __init__(self, txt):
+    def __init__(self, txt, metrics=None):
         """
         Initialize class
 
         Args:
-            txt (list): List of strings to visualize
+            txt (list): List of strings to visualize, any indexable sequence of strings works (e.g. one reading lazily from disk)
+            metrics (Metrics, optional): collects stage timings and counters, e.g. Metrics(trace_memory=True, hooks=[...]),
+                defaults to None which creates one, available as pt.metrics
         """
         self.txt = txt
         self.txt_embeddings = None
@@ -39,8 +62,22 @@ class PictureText(object):
         self.linkage_table = None
         self.hac_method = None
         self.hac_metric = None
+        self.linkage_engine = None
+        # Engine and budget requested in the last call, reused when add_documents reruns HAC
+        self.linkage_options = {'linkage_engine': 'auto', 'memory_budget': None}
+        self.approx_clusters = None
+        self.tree = None
+        self.layout_cache = LayoutCache()
+        self.incremental = None
+        self.built_size = 0
+        self._embedding_buffer = None
+        self.added_size = 0
+        self.content_hash = None
+        self.metrics = metrics if metrics is not None else Metrics()
 
-    def __call__(self, txt_embeddings=None, encoder=sbert_encoder, hac_method='ward', hac_metric='euclidean'):
+    def __call__(self, txt_embeddings=None, encoder=sbert_encoder, hac_method='ward', hac_metric='euclidean', embedding_store=None,
+                chunk_size=None, embeddings_path=None, progress=False, linkage_engine='auto', memory_budget=None,
+                approx_clusters=None, encoder_id=None):
         """
         Calls embeddings and generates HAC linkage table. Can either provide embeddings or an encoder.
         Call method can be triggered multiple times with updates to embeddings or linkage when relevant
@@ -50,22 +87,31 @@ class PictureText(object):
             encoder (object): encoder function used to generate txt_embeddings if none provided, defaults to sbert_encoder
             hac_method (string): HAC method used by fastcluster, defaults to 'ward'
             hac_metric (string): Distrance metric used by fastcluster, defaults to 'euclidean'
+            embedding_store (EmbeddingStore, optional): on-disk embedding cache, when provided only texts missing from it are encoded,
+                the encoder must then be a module-level function, a partial of one or have an encoder_id (see encoder_identity), defaults to None
+            chunk_size (int, optional): when set, texts are encoded in chunks of this size into a preallocated float32 matrix, defaults to None (single encoder call)
+            embeddings_path (string, optional): .npy file to memory-map the chunked embeddings to, defaults to None which keeps them in RAM
+            progress (bool or object, optional): progress reporting for chunked encoding, see encode_stream, defaults to False
+            linkage_engine (string, optional): 'auto', 'vector' (fastcluster.linkage_vector, O(N) memory) or 'matrix' (fastcluster.linkage, O(N^2) memory),
+                'auto' switches to the vector engine when the matrix one would need more than half of memory_budget, defaults to 'auto'
+            memory_budget (int or string, optional): maximal memory the linkage may use, e.g. '8GB', a LinkageMemoryError is raised before running if the estimate exceeds it,
+                defaults to None which uses the available physical memory
+            approx_clusters (int, optional): when set, runs approximate two-stage HAC for very large corpora: embeddings are compressed into this many
+                micro-clusters with mini-batch k-means and HAC runs on their centroids (see approximate_linkage), defaults to None (exact HAC)
+            encoder_id (string, optional): identity of the encoder in embedding_store, needed for lambdas, local functions and callable objects
+                without an encoder_id attribute, defaults to None which derives it via encoder_identity
 
         >>> pt = PictureText(['txt','txt','txt','txt','txt','txt','txt'])
         >>> pt([[1], [3], [1], [3], [1], [3], [1]])
-        Embeddings updated, external embeddings provided
-        Linkage updated, using ward method and euclidean distances, time taken 0 secs
         >>> pt.txt_embeddings
         [[1], [3], [1], [3], [1], [3], [1]]
         >>> pt(encoder = lambda x: [[1]]*len(x))
-        Embeddings updated, using encoder, time taken 0 secs
-        Linkage updated, using ward method and euclidean distances, time taken 0 secs
         >>> pt.txt_embeddings
         [[1], [1], [1], [1], [1], [1], [1]]
+        >>> sorted(pt.metrics.stages), pt.metrics.stages['linkage']['calls'], pt.metrics.counters['documents_encoded']
+        (['encode', 'linkage'], 2, 7)
         >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
         >>> pt(X)
-        Embeddings updated, external embeddings provided
-        Linkage updated, using ward method and euclidean distances, time taken 0 secs
         >>> pt.txt_embeddings
         [[1001], [1000], [1], [10], [99], [100], [101]]
         >>> pt.linkage_table
@@ -77,33 +123,171 @@ class PictureText(object):
                [7.00000000e+00, 1.10000000e+01, 1.58601647e+03, 7.00000000e+00]])
         >>> pt.hac_method
         'ward'
+        >>> pt.linkage_engine
+        'matrix'
         """
         # Set embeddings if those are missing or if we changed the embeddings
-        if txt_embeddings:
+        if txt_embeddings is not None:
             self.txt_embeddings = txt_embeddings
             self.linkage_table = None
             assert(len(self.txt_embeddings)==len(self.txt))
-            print('Embeddings updated, external embeddings provided')
+            logger.info('Embeddings updated, external embeddings provided')
         # Calculate embeddings if those are missing and the encoder is unchanged do nothing
         elif (encoder == self.encoder):
             pass
         else:
-            t = TimeClass()
-            self.encoder = encoder
-            self.txt_embeddings = self.encoder(self.txt)
-            self.linkage_table = None
-            secs, _ = t.take()
+            with self.metrics.stage('encode') as run:
+                self.encoder = encoder
+                if embedding_store is None:
+                    encode = self.encoder
+                else:
+                    encode = lambda text_list: embedding_store.encode(text_list, self.encoder, encoder_id=encoder_id)
+                if chunk_size:
+                    self.txt_embeddings = encode_stream(self.txt, encode, chunk_size=chunk_size, out_path=embeddings_path, progress=progress)
+                else:
+                    self.txt_embeddings = encode(self.txt)
+                self.linkage_table = None
             assert(len(self.txt_embeddings)==len(self.txt))
-            print(f'Embeddings updated, using encoder, time taken {secs} secs')
+            self.metrics.count('documents_encoded', len(self.txt))
+            logger.info('Embeddings updated, using encoder, time taken %.3f secs', run['seconds'])
 
         # Generate linkage table or update it if parameters for HAC have changed
-        if (np.all(self.linkage_table==None)) or (hac_method!=self.hac_method) or (hac_metric!=self.hac_metric):
-            t = TimeClass()
-            self.hac_method = hac_method
-            self.hac_metric = hac_metric
-            self.linkage_table = fastcluster.linkage(self.txt_embeddings, method=hac_method, metric=hac_metric)
-            secs, _ = t.take()
-            print(f'Linkage updated, using {hac_method} method and {hac_metric} distances, time taken {secs} secs')
+        if (np.all(self.linkage_table==None)) or (hac_method!=self.hac_method) or (hac_metric!=self.hac_metric) \
+                or (approx_clusters!=self.approx_clusters):
+            with self.metrics.stage('linkage') as run:
+                self.hac_method = hac_method
+                self.hac_metric = hac_metric
+                self.approx_clusters = approx_clusters
+                self.linkage_options = {'linkage_engine': linkage_engine, 'memory_budget': memory_budget}
+                if approx_clusters:
+                    self.linkage_table = approximate_linkage(self.txt_embeddings, n_micro=approx_clusters, method=hac_method, metric=hac_metric)
+                    self.linkage_engine = 'approximate'
+                else:
+                    self.linkage_table, self.linkage_engine = linkage(self.txt_embeddings, method=hac_method, metric=hac_metric,
+                                                            engine=linkage_engine, memory_budget=memory_budget)
+            # Cached splits and summaries belong to the previous linkage
+            self.tree = None
+            self.layout_cache.clear()
+            self.incremental = None
+            self.built_size = len(self.txt)
+            self.added_size = 0
+            logger.info('Linkage updated, using %s method and %s distances, time taken %.3f secs', hac_method, hac_metric, run['seconds'])
+
+    def add_documents(self, txt, txt_embeddings=None, rebuild_threshold=0.1):
+        """
+        Adds documents to the existing tree without recomputing HAC: only the new texts are encoded and each one is
+        attached to the closest subtree (see IncrementalLinkage). Greedy insertion drifts from what HAC would build,
+        so once the documents added since the last full build exceed rebuild_threshold of its size, HAC is rerun on everything
+
+        Args:
+            txt (list): List of strings to add
+            txt_embeddings (list, optional): embeddings of txt, defaults to None which encodes txt with the encoder of the last call
+            rebuild_threshold (float, optional): share of documents added since the last full build that triggers a rebuild, defaults to 0.1
+
+        >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
+        >>> pt = PictureText(['txt']*7)
+        >>> pt(X)
+        >>> pt.add_documents(['new txt'], [[102]], rebuild_threshold=0.2)
+        >>> pt.tree.members(11)
+        [4, 5, 6, 7]
+        >>> pt.add_documents(['newer txt'], [[2]], rebuild_threshold=0.2)
+        >>> pt.linkage_table.shape
+        (8, 4)
+        >>> pt.metrics.counters['documents_added'], pt.metrics.counters['rebuilds']
+        (2, 1)
+        >>> pt = PictureText(['txt']*7)
+        >>> pt(X, linkage_engine='vector')
+        >>> pt.add_documents(['rebuilt txt'], [[3]], rebuild_threshold=0.1)
+        >>> pt.linkage_engine, len(pt.txt), pt.txt_embeddings.shape
+        ('vector', 8, (8, 1))
+        >>> PictureText(['txt']*7).add_documents(['txt'])
+        Traceback (most recent call last):
+            ...
+        ValueError: Call the PictureText before adding documents
+        >>> pt.add_documents(['txt'])
+        Traceback (most recent call last):
+            ...
+        ValueError: No encoder to embed the new documents, the embeddings were provided externally, pass txt_embeddings
+        """
+        if np.all(self.linkage_table==None):
+            raise ValueError('Call the PictureText before adding documents')
+        if txt_embeddings is None and self.encoder is None:
+            raise ValueError('No encoder to embed the new documents, the embeddings were provided externally, pass txt_embeddings')
+        if txt_embeddings is None:
+            with self.metrics.stage('encode'):
+                txt_embeddings = self.encoder(txt)
+            self.metrics.count('documents_encoded', len(txt))
+        txt_embeddings = np.asarray(txt_embeddings)
+        assert(len(txt_embeddings)==len(txt))
+        with self.metrics.stage('insert'):
+            if self.incremental is None:
+                self.incremental = IncrementalLinkage(self.linkage_table, self.txt_embeddings, method=self.hac_method, metric=self.hac_metric)
+            for x in txt_embeddings:
+                self.incremental.insert(x)
+        self.metrics.count('documents_added', len(txt))
+        self._append(txt, txt_embeddings)
+        self.added_size += len(txt)
+        drift = self.added_size / self.built_size
+        logger.info('Added %d documents, drift %.2f of the %s rebuild threshold', len(txt), drift, rebuild_threshold)
+        if drift > rebuild_threshold:
+            self.metrics.count('rebuilds')
+            self(self.txt_embeddings, hac_method=self.hac_method, hac_metric=self.hac_metric, approx_clusters=self.approx_clusters,
+                **self.linkage_options)
+        else:
+            self.linkage_table = self.incremental.linkage_table()
+            self.tree = HACTree(self.linkage_table)
+            self.layout_cache.clear(source=self.linkage_table)
+
+    def _append(self, txt, txt_embeddings):
+        """
+        Appends texts and embeddings in place. Embeddings live in a buffer with spare capacity that doubles when full,
+        so each call costs the size of the batch rather than of the corpus. The buffer and a private text list are set up
+        on the first call, and again whenever the embeddings were replaced in between
+        """
+        buffer = self._embedding_buffer
+        n, m = len(self.txt), len(txt)
+        if buffer is None or self.txt_embeddings is not buffer['view'] or self.txt is not buffer['txt']:
+            embeddings = np.asarray(self.txt_embeddings)
+            dtype = np.result_type(embeddings.dtype, txt_embeddings.dtype, np.float32)
+            data = np.empty((max(2 * (n + m), 16), embeddings.shape[1]), dtype=dtype)
+            data[:n] = embeddings
+            buffer = self._embedding_buffer = {'data': data, 'txt': list(self.txt)}
+        elif n + m > len(buffer['data']):
+            data = np.empty((2 * (n + m), buffer['data'].shape[1]), dtype=buffer['data'].dtype)
+            data[:n] = buffer['data'][:n]
+            buffer['data'] = data
+        buffer['data'][n:n+m] = txt_embeddings
+        buffer['txt'].extend(txt)
+        buffer['view'] = buffer['data'][:n+m]
+        self.txt = buffer['txt']
+        self.txt_embeddings = buffer['view']
+
+    def save(self, path, df_res=None):
+        """
+        Saves embeddings, linkage table, HAC settings, text and optionally a node table to a versioned bundle directory (see picture_text.src.bundle)
+
+        Args:
+            path (string): bundle directory
+            df_res (DataFrame, optional): output of hac_to_treemap or make_picture to store along, defaults to None
+        Returns:
+            content hash of the bundle (string), usable to validate caches built from it
+        """
+        with self.metrics.stage('save'):
+            self.content_hash = save_bundle(self, path, df_res=df_res)
+        return self.content_hash
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """
+        Loads a PictureText saved with save. Embeddings, text and tree stay memory-mapped, so loading does not scale with corpus size
+
+        Args:
+            path (string): bundle directory
+            verify (bool, optional): check the bundle against its content hash, reads the whole bundle, defaults to False
+        Returns:
+            PictureText
+        """
+        return load_bundle(path, verify=verify)
 
     def make_picture(self, 
                 summarizer = None,
@@ -113,12 +297,21 @@ class PictureText(object):
                 layer_max_extension = 1,
                 treemap_average_score = None, 
                 treemap_maxdepth=3,
+                summarizer_workers = None,
+                summarizer_executor = 'thread',
+                summarizer_timeout = None,
                 ):
         """
         Creates the HAC treemap picture of text
 
         Args:
-            summarizer (object): Summarizer function of the form summary, summary_quality = summarizer(list_text,list_embeddings) and returns a summary (string) and summary_quality (float), defaults None which uses cluster_summary_simple
+            summarizer (object): Summarizer function of the form summary, summary_quality = summarizer(list_text,list_embeddings) and returns a summary (string) and summary_quality (float),
+                or a batched summarizer of the form labels, scores = summarizer(nodes) called once for all nodes (see picture_text.src.summarizers.batched_summarizer),
+                defaults None which uses centroid_summarizer, the vectorized form of cluster_summary_simple
+            Used by parallel_summarizer for expensive per node summarizers:
+                summarizer_workers (int, optional): Number of workers summarizing nodes in parallel, defaults to None which runs them one by one
+                summarizer_executor (string, optional): 'thread' or 'process' pool, defaults to 'thread'
+                summarizer_timeout (float, optional): Seconds a single node summary may run, counted from when a worker starts it. Nodes over time get a placeholder label and their work is abandoned, defaults to None (no timeout)
             Used by hac_to_treemap:
                 layer_size (int, optional): Minimal number of clusters per layer, defaults to 3
                 layer_depth (int, optional): Number of layers to return. This will be the number of drilldowns available in treemap, defaults to 6
@@ -132,25 +325,36 @@ class PictureText(object):
             df_res: DataFrame with data
             fig: Interactive plotly treemap
         """
-        # Set summarizer
-        if summarizer:
+        # Set summarizer, cluster_summary_simple has a vectorized batched equivalent
+        if summarizer and summarizer != self.cluster_summary_simple:
             self.summarizer = summarizer
         else:
-            self.summarizer = self.cluster_summary_simple
+            self.summarizer = centroid_summarizer
+        # Summaries are cached per summarizer, however it is run
+        summarizer_key = self.summarizer
+        if summarizer_workers and not is_batched(self.summarizer):
+            self.summarizer = parallel_summarizer(self.summarizer, workers=summarizer_workers,
+                                    executor=summarizer_executor, timeout=summarizer_timeout)
         # Convert HAC linkage table into tree map form
         df_res = self.hac_to_treemap(self.linkage_table, depth=layer_depth, nr_splits=layer_size, min_size=layer_min_size,max_extension=layer_max_extension,)
-        # Get summaries for each cluster
-        df_res['labels'], df_res['color']= zip(*df_res.apply(lambda x: \
-            self.summarizer([np.array(self.txt[m]) for m in x['cluster_members']], \
-                                [np.array(self.txt_embeddings[m]) for m in x['cluster_members']]), axis=1))
+        # Get summaries for all clusters not summarized before at once, per node summarizers run through an adapter
+        with self.metrics.stage('summarize'):
+            nodes = TreeNodes.from_tree(self.tree, self.txt_embeddings, self.txt, df_res['id'])
+            hits, misses = self.layout_cache.hits, self.layout_cache.misses
+            df_res['labels'], df_res['color'] = self.layout_cache.summarize(summarizer_key, self.summarizer, nodes)
+        self.metrics.count('summaries_computed', self.layout_cache.misses - misses)
+        self.metrics.count('summary_cache_hits', self.layout_cache.hits - hits)
         # Calculate overall tree map average score
         if treemap_average_score:
             self.average_score = treemap_average_score
         else:
-            self.average_score = df_res.apply(lambda x: x['color']*x['value'],axis=1).sum()/df_res.value.sum()
-        print(f'Picture weighted average {round(self.average_score,2)}')
+            # Nodes without a score (e.g. summaries that timed out) are left out of the average
+            scored = df_res['color'].notna()
+            self.average_score = (df_res['color']*df_res['value'])[scored].sum()/df_res.value[scored].sum()
+        logger.info('Picture weighted average %.2f', self.average_score)
         # Draw tree map
-        fig = build_tree_map(df_res,maxdepth=treemap_maxdepth,average_score=self.average_score)
+        with self.metrics.stage('figure'):
+            fig = build_tree_map(df_res,maxdepth=treemap_maxdepth,average_score=self.average_score)
         return df_res, fig
     
     def cluster_summary_simple(self,clust_txt,clust_embeddings,top_n=1, text_if_empty='blank'):
@@ -196,10 +400,13 @@ class PictureText(object):
     def hac_to_treemap(self, linkage_table, depth=3, nr_splits=3,min_size=0.1,max_extension=1):
         """
         Starting from a list of vectors, performs HAC using fastcluster, then splits results into a
-        series of layers with each layer consisting of a roughly equivalent number of slices
+        series of layers with each layer consisting of a roughly equivalent number of slices.
+        All layers share one HACTree (kept in self.tree), the cluster_table column holds HACSubtree views onto it.
+        Split decisions are memoized per node and split parameters in self.layout_cache, so calls with new
+        parameters only split the nodes not seen before. The cache is dropped when the linkage changes
 
         Args:
-            linkage_table (list): Linkage table produced as an output of a HAC algorithm (fastcluster or scipy)
+            linkage_table (list or HACTree): Linkage table produced as an output of a HAC algorithm (fastcluster or scipy), or a HACTree built from one
             method (string, optional): Method used in HAC, feeds directly into fastcluster, defaults to 'single'
             depth (int, optional): Number of layers to return. This will be the number of drilldowns available in treemap, defaults to 3
             nr_splits (int, optional): Number of clusters to seek to split each layer into, defaults to 3
@@ -216,48 +423,60 @@ class PictureText(object):
         >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
         >>> pt = PictureText(['txt']*7)
         >>> pt(X)
-        Embeddings updated, external embeddings provided
-        Linkage updated, using ward method and euclidean distances, time taken 0 secs
         >>> df = pt.hac_to_treemap(pt.linkage_table)
         >>> df.drop('cluster_table',axis=1)
-            id parent cluster_members value
-        9    9   Full       [4, 5, 6]     3
-        10  10   Full          [2, 3]     2
-        7    7   Full          [0, 1]     2
-        5    5      9             [5]     1
-        6    6      9             [6]     1
-        4    4      9             [4]     1
-        2    2     10             [2]     1
-        3    3     10             [3]     1
-        0    0      7             [0]     1
-        1    1      7             [1]     1
+           id parent value
+        0   9   Full     3
+        1  10   Full     2
+        2   7   Full     2
+        3   5      9     1
+        4   6      9     1
+        5   4      9     1
+        6   2     10     1
+        7   3     10     1
+        8   0      7     1
+        9   1      7     1
         >>> list(df['cluster_table'].values)
-        [{4: [4, '', '', 0, 1], 5: [5, '', '', 0, 1], 6: [6, '', '', 0, 1], 8: [8, 5, 6, 1.0, 2], 9: [9, 4, 8, 1.7320508075688772, 3]}, {2: [2, '', '', 0, 1], 3: [3, '', '', 0, 1], 10: [10, 2, 3, 9.0, 2]}, {0: [0, '', '', 0, 1], 1: [1, '', '', 0, 1], 7: [7, 0, 1, 1.0, 2]}, {5: [5, '', '', 0, 1]}, {6: [6, '', '', 0, 1]}, {4: [4, '', '', 0, 1]}, {2: [2, '', '', 0, 1]}, {3: [3, '', '', 0, 1]}, {0: [0, '', '', 0, 1]}, {1: [1, '', '', 0, 1]}]
+        [HACSubtree(root=9, size=3), HACSubtree(root=10, size=2), HACSubtree(root=7, size=2), HACSubtree(root=5, size=1), HACSubtree(root=6, size=1), HACSubtree(root=4, size=1), HACSubtree(root=2, size=1), HACSubtree(root=3, size=1), HACSubtree(root=0, size=1), HACSubtree(root=1, size=1)]
+        >>> df['cluster_table'][0].members()
+        [4, 5, 6]
+        >>> df = pt.hac_to_treemap(pt.linkage_table, depth=2)
+        >>> pt.layout_cache.hits, pt.layout_cache.misses
+        (4, 11)
+        >>> pt.metrics.counters['nodes_built'], pt.metrics.counters['split_cache_hits'], pt.metrics.stages['tree']['calls']
+        (20, 4, 1)
         """
         go = True
         clust_idx = 'Full'
         all_res = []
-        #df_res = pd.DataFrame([],columns=['cluster_id', 'cluster_parent', 'cluster_members', 'cluster_table', 'cluster_size'])
-
-        hac = HAC(linkage_table, parent = clust_idx)
-        new_clusters = hac.top_n_good_clusters(nr_splits,min_size=min_size,max_extension=max_extension)
-
-        all_res.append(pd.DataFrame(new_clusters).T)
-        depth=depth-1
-
-        while go and depth>0:
-            new_res = {}
-            for c in new_clusters:
-                hac = HAC(new_clusters[c]['cluster_table'],parent=c)
-                interim_clusters = hac.top_n_good_clusters(nr_splits,min_size=min_size,max_extension=max_extension)
-                new_res = {**new_res, **interim_clusters}
-            all_res.append(pd.DataFrame(new_res).T)
-            new_clusters=new_res
+        #df_res = pd.DataFrame([],columns=['cluster_id', 'cluster_parent', 'cluster_table', 'cluster_size'])
+
+        if self.tree is None or self.layout_cache.source is not linkage_table:
+            with self.metrics.stage('tree'):
+                self.tree = linkage_table if isinstance(linkage_table, HACTree) else HACTree(linkage_table)
+            self.layout_cache.clear(source=linkage_table)
+        hits, misses = self.layout_cache.hits, self.layout_cache.misses
+        with self.metrics.stage('treemap'):
+            new_clusters = self.layout_cache.split(self.tree, clust_idx, nr_splits, min_size, max_extension)
+
+            all_res.append(pd.DataFrame(new_clusters).T)
             depth=depth-1
-            if depth<1:
-                go = False
 
-        col_nm={'cluster_size':'value','cluster_id':'id','cluster_parent':'parent'}
-        df_res = pd.concat(all_res,ignore_index=True)
-        df_res=df_res.rename(columns=col_nm)
+            while go and depth>0:
+                new_res = {}
+                for c in new_clusters:
+                    interim_clusters = self.layout_cache.split(new_clusters[c]['cluster_table'], c, nr_splits, min_size, max_extension)
+                    new_res = {**new_res, **interim_clusters}
+                all_res.append(pd.DataFrame(new_res).T)
+                new_clusters=new_res
+                depth=depth-1
+                if depth<1:
+                    go = False
+
+            col_nm={'cluster_size':'value','cluster_id':'id','cluster_parent':'parent'}
+            df_res = pd.concat(all_res,ignore_index=True)
+            df_res=df_res.rename(columns=col_nm)
+        self.metrics.count('nodes_built', len(df_res))
+        self.metrics.count('splits_computed', self.layout_cache.misses - misses)
+        self.metrics.count('split_cache_hits', self.layout_cache.hits - hits)
         return df_res
\ No newline at end of file
@@ -0,0 +1,381 @@
+"""
+Offline preparation of the Dash app collections. Building a collection runs HAC, layering, summaries and
+figures once and writes them to disk: the PictureText bundle (see picture_text.src.bundle) with the node table,
+the figures as JSON and the text records one utf-8 column per field. The server only memory-maps the
+result, so its startup does not scale with corpus size and all gunicorn workers share one copy in the page cache.
+
+Build all collections ahead of serving with
+    python -m picture_text.src.app_data [--force] [collection ...]
+"""
+import argparse
+import ast
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+from picture_text.picture_text import PictureText
+from picture_text.src.bundle import load_node_table, write_text, read_text
+from picture_text.src.treemap import build_sunburst, build_tree_map, build_node_index
+from picture_text.src.summarizers import centroid_summaries
+from picture_text.src.explainers import SAMPLE_DETAILS
+
+logger = logging.getLogger(__name__)
+
+model = 'gpt4'
+extract_schema = 'summary_entity1'
+emb_model_name = 'oAI-3s'
+root_path = os.environ.get('VST_SAMPLE_DATA','./sample_data')
+build_path = os.environ.get('VST_BUILD_DATA', os.path.join(root_path, 'build'))
+treemap_width = 400
+test = int(os.environ.get("VST_TEST",100))
+# Bump when the build output changes so older builds are rebuilt
+BUILD_VERSION = 2
+
+def source_path(collection_name):
+    return os.path.join(root_path,f'topic_n_ent_{collection_name}_{model}_{extract_schema}_{emb_model_name}.json')
+
+def collection_path(collection_name, out_dir=None):
+    return os.path.join(out_dir or build_path, collection_name)
+
+def build_settings(collection_name, width=treemap_width):
+    """
+    Everything a build depends on, a build is reused only while these match
+    """
+    h = hashlib.sha256()
+    with open(source_path(collection_name), 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return {'build_version': BUILD_VERSION, 'source_hash': h.hexdigest(), 'test': test, 'width': width}
+
+def parse_entities(mentioned_entities):
+    """
+    Parses the mentioned_entities field, a python literal list of {'named_entity': ...} dictionaries, into the list of entity names.
+    Uses literal_eval, malformed values give no entities
+
+    >>> parse_entities("[{'named_entity': 'Apple', 'type': 'ORG'}, {'named_entity': 'Tim Cook'}]")
+    ['Apple', 'Tim Cook']
+    >>> parse_entities("__import__('os')"), parse_entities([])
+    ([], [])
+    """
+    if isinstance(mentioned_entities, str):
+        try:
+            mentioned_entities = ast.literal_eval(mentioned_entities)
+        except (ValueError, SyntaxError):
+            return []
+    if not isinstance(mentioned_entities, list):
+        return []
+    return [str(ent['named_entity']) for ent in mentioned_entities if isinstance(ent, dict) and 'named_entity' in ent]
+
+def prep_data(collection_name, width = treemap_width):
+    """
+    Runs HAC, layering, summaries and figures of a collection in memory
+
+    Returns:
+        dictionary with the fitted PictureText, node table, figures and text records without embeddings
+    """
+    text_data = json.load(open(source_path(collection_name),'r'))
+
+    if test > 0:
+        text_data = text_data[:test]
+
+    txt_embeddings = [td['embedding'] for td in text_data]
+    txt = [f"{td['topic_tag']}" for td in text_data]
+    txt_file = [f"{td['file']}" for td in text_data]
+    tag_to_file = {txt[i]:txt_file[i] for i in range(len(txt))}
+    pt = PictureText(txt)
+    pt(txt_embeddings=txt_embeddings,encoder=None,hac_method='ward', hac_metric='euclidean')
+    df_res = pt.hac_to_treemap(pt.linkage_table,
+                   depth=4,
+                   nr_splits=3,
+                   min_size=0.1,
+                   max_extension=1,)
+    df_res['labels'], df_res['score'] = centroid_summaries(pt.tree, txt_embeddings, txt, df_res['id'])
+    df_res['tag_file'] = df_res['labels'].apply(lambda x: tag_to_file.get(x,x))
+    color_discrete_map={'(?)':'black'}
+    nickname_colors = {
+        "392_bach": "gold", "398_zuck": "blue", "darkblue": "Musk", "405_bezos": "grey",
+        "416_lecun": "orange", "419_sama": "red", "ADSK_Q4": "gold", "BBY_Q4": "blue",
+        "BUD_Q4": "darkblue", "CRM_Q4": "grey", "DOCU_Q4": "orange", "JWN_Q4": "green",
+        "KR_Q4": "red", "SNOW_Q4": "purple",
+    }
+    color_discrete_map={**color_discrete_map, **nickname_colors}
+    df_res['tag_color'] = df_res['tag_file'].apply(lambda x: color_discrete_map.get(x,'grey'))
+
+    # Figures only get the columns they show, cluster_table never reaches the client
+    df_fig = df_res.drop(columns=['cluster_table'])
+    trm_fig = build_tree_map(df_fig)
+    trm_fig.update_layout(height = int(width*1.5), width = width)
+    sun_fig = build_sunburst(df_fig)
+    sun_fig.update_layout(height = int(width*1.5), width = width)
+    del txt_embeddings
+    del txt
+    for e in text_data:
+        del e['embedding']
+        # Parsed once here so serving never evaluates the raw string
+        if 'mentioned_entities' in e:
+            e['entities'] = parse_entities(e.pop('mentioned_entities'))
+    logger.info('Finished prepping %s ::: %d %s', collection_name, len(text_data), list(text_data[0].keys()))
+    return {
+        "picture_text": pt,
+        "df_res": df_res,
+        "sunburst": sun_fig,
+        "treemap": trm_fig,
+        "text_data": text_data}
+
+class Records():
+    """
+    Read-only list of text records stored one column per field, each record is decoded when accessed
+    """
+    def __init__(self, columns, json_fields=()):
+        """
+        Args:
+            columns (dict): field name to TextColumn
+            json_fields (list, optional): fields stored as JSON rather than plain strings, defaults to ()
+
+        >>> from picture_text.src.bundle import TextColumn
+        >>> col = lambda s: TextColumn(np.frombuffer(''.join(s).encode(), dtype=np.uint8), np.cumsum([0] + [len(x) for x in s]))
+        >>> records = Records({'title': col(['a', 'b']), 'tags': col(['[1]', '[]'])}, json_fields=['tags'])
+        >>> len(records), records[0]
+        (2, {'title': 'a', 'tags': [1]})
+        """
+        self.columns = columns
+        self.json_fields = set(json_fields)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def field(self, i, name):
+        value = self.columns[name][i]
+        return json.loads(value) if name in self.json_fields else value
+
+    def __getitem__(self, i):
+        return {name: self.field(i, name) for name in self.columns}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class NodeIndex():
+    """
+    Members of the node table's nodes by node id as a string, the form treemap clicks report them in.
+    Members are read from the tree on demand, so the index holds no per node member lists
+
+    >>> import fastcluster
+    >>> from picture_text.src.hac_tools import HACTree
+    >>> index = NodeIndex(HACTree(fastcluster.single([[1001], [1000], [1], [10]])), [4, 5, 0])
+    >>> index.get('5'), index.get('0'), index.get('6')
+    ([2, 3], [0], None)
+    """
+    def __init__(self, tree, node_ids):
+        self.tree = tree
+        self.node_ids = frozenset(str(i) for i in node_ids)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        return node_id in self.node_ids
+
+    def get(self, node_id, default=None):
+        if node_id not in self.node_ids:
+            return default
+        return self.tree.members(int(node_id))
+
+def write_records(path, text_data):
+    """
+    Stores text records one column per field in path
+
+    Returns:
+        list of [field, kind] with kind 'text' or 'json'
+    """
+    os.makedirs(path, exist_ok=True)
+    fields = []
+    for name in text_data[0].keys() if text_data else []:
+        values = [td.get(name) for td in text_data]
+        if all(isinstance(v, str) for v in values):
+            write_text(os.path.join(path, name), values)
+            fields.append([name, 'text'])
+        else:
+            write_text(os.path.join(path, name), [json.dumps(v) for v in values])
+            fields.append([name, 'json'])
+    return fields
+
+@contextmanager
+def build_lock(collection_name, out_dir=None, shared=False):
+    """
+    File lock on the build of a collection, held exclusively while a build is swapped in and shared while one is read.
+    Works across processes, e.g. gunicorn workers loading the collection and the build command
+    """
+    lock_path = collection_path(collection_name, out_dir) + '.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_build(collection_name, width=treemap_width, out_dir=None):
+    """
+    Builds a collection into a new private directory next to the final one and returns its path
+    """
+    settings = build_settings(collection_name, width=width)
+    data = prep_data(collection_name, width=width)
+    os.makedirs(out_dir or build_path, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f'.{collection_name}.', dir=out_dir or build_path)
+    try:
+        data['picture_text'].save(os.path.join(tmp_path, 'bundle'), data['df_res'])
+        for name in ['treemap', 'sunburst']:
+            with open(os.path.join(tmp_path, f'{name}.json'), 'w') as f:
+                f.write(data[name].to_json())
+        settings['record_fields'] = write_records(os.path.join(tmp_path, 'records'), data['text_data'])
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(settings, f, indent=1)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return tmp_path
+
+def swap_build(tmp_path, path):
+    """
+    Moves a finished build into place, the caller holds the exclusive build_lock.
+    The old build is renamed aside before being removed, so the target is never a partially deleted directory.
+    Readers that already opened files of the old build keep reading them, removed files stay valid while open or mapped
+    """
+    old_path = None
+    if os.path.exists(path):
+        old_path = tmp_path + '.old'
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def build_collection(collection_name, width=treemap_width, out_dir=None):
+    """
+    Builds a collection and writes it to out_dir/collection_name, replacing an older build
+
+    Args:
+        collection_name (string): key of SAMPLE_DETAILS
+        width (int, optional): figure width, defaults to treemap_width
+        out_dir (string, optional): build directory, defaults to VST_BUILD_DATA or sample_data/build
+    """
+    # Built without the lock, so servers keep loading the old build meanwhile, only the swap excludes them
+    tmp_path = write_build(collection_name, width=width, out_dir=out_dir)
+    path = collection_path(collection_name, out_dir)
+    with build_lock(collection_name, out_dir):
+        swap_build(tmp_path, path)
+    logger.info('Finished building %s in %s', collection_name, path)
+
+def read_manifest(collection_name, out_dir=None):
+    try:
+        with open(os.path.join(collection_path(collection_name, out_dir), 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_id(manifest, content_hash=''):
+    """
+    Identity of a build: the manifest (source hash, build version and settings) together with the bundle content hash.
+    Unlike the bundle content hash alone it changes whenever the text records or the node table can change
+
+    >>> a = build_id({'build_version': 2, 'source_hash': 'ab', 'width': 400})
+    >>> a == build_id({'width': 400, 'source_hash': 'ab', 'build_version': 2}), a == build_id({'build_version': 3, 'source_hash': 'ab', 'width': 400})
+    (True, False)
+    >>> a == build_id({'build_version': 2, 'source_hash': 'ab', 'width': 400}, 'cd')
+    False
+    """
+    h = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    h.update(content_hash.encode('utf-8'))
+    return h.hexdigest()
+
+def is_built(collection_name, width=treemap_width, out_dir=None):
+    """
+    Checks whether an up to date build of the collection exists
+    """
+    manifest = read_manifest(collection_name, out_dir)
+    if manifest is None:
+        return False
+    settings = build_settings(collection_name, width=width)
+    return all(manifest.get(k) == v for k, v in settings.items())
+
+def load_collection(collection_name, out_dir=None, build_if_missing=True):
+    """
+    Loads a built collection, memory-mapped wherever possible. Falls back to building it first if there is no build.
+    An existing build is used as is, keeping it up to date with the source is left to the build command
+
+    Args:
+        collection_name (string): key of SAMPLE_DETAILS
+        out_dir (string, optional): build directory, defaults to VST_BUILD_DATA or sample_data/build
+        build_if_missing (bool, optional): build the collection when there is no build, defaults to True
+    Returns:
+        dictionary with df_res (node table), node_index (node id as string to its sorted members),
+        tree_index (see build_node_index), treemap and sunburst (figure dictionaries), text_data (Records),
+        content_hash (of the bundle) and build_id (see build_id, identifies the build)
+    """
+    path = collection_path(collection_name, out_dir)
+    with build_lock(collection_name, out_dir, shared=True):
+        manifest = read_manifest(collection_name, out_dir)
+        if manifest is not None:
+            return read_collection(path, manifest)
+    if not build_if_missing:
+        raise FileNotFoundError(f'No build of {collection_name}, run python -m picture_text.src.app_data {collection_name}')
+    # Checked again under the exclusive lock, so concurrent loads build the collection only once
+    with build_lock(collection_name, out_dir):
+        manifest = read_manifest(collection_name, out_dir)
+        if manifest is None:
+            swap_build(write_build(collection_name, out_dir=out_dir), path)
+            logger.info('Finished building %s in %s', collection_name, path)
+            manifest = read_manifest(collection_name, out_dir)
+        return read_collection(path, manifest)
+
+def read_collection(path, manifest):
+    """
+    Reads the build at path, see load_collection
+    """
+    pt = PictureText.load(os.path.join(path, 'bundle'))
+    figures = {}
+    for name in ['treemap', 'sunburst']:
+        with open(os.path.join(path, f'{name}.json')) as f:
+            figures[name] = json.load(f)
+    fields = manifest['record_fields']
+    records = Records({name: read_text(os.path.join(path, 'records', name)) for name, _ in fields},
+                        json_fields=[name for name, kind in fields if kind == 'json'])
+    df_res = load_node_table(os.path.join(path, 'bundle'), pt.tree)
+    return {
+        "df_res": df_res,
+        # Treemap clicks report node ids as strings
+        "node_index": NodeIndex(pt.tree, df_res['id']),
+        "tree_index": build_node_index(df_res),
+        "content_hash": pt.content_hash,
+        "build_id": build_id(manifest, pt.content_hash),
+        "sunburst": figures['sunburst'],
+        "treemap": figures['treemap'],
+        "text_data": records}
+
+def collection_nbytes(collection):
+    """
+    Approximate memory held by a loaded collection: the node table, the figures and the mapped text records
+    """
+    nbytes = int(collection['df_res'].memory_usage(deep=True).sum())
+    nbytes += sum(len(json.dumps(collection[name])) for name in ['treemap', 'sunburst'])
+    for column in collection['text_data'].columns.values():
+        nbytes += column.data.nbytes + column.offsets.nbytes
+    return nbytes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the app collections ahead of serving')
+    parser.add_argument('collections', nargs='*', help='collections to build, defaults to all of SAMPLE_DETAILS')
+    parser.add_argument('--force', action='store_true', help='rebuild collections that are up to date')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    for collection_name in args.collections or SAMPLE_DETAILS.keys():
+        if args.force or not is_built(collection_name):
+            build_collection(collection_name)
+        else:
+            logger.info('Up to date %s', collection_name)
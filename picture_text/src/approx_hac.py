@@ -0,0 +1,233 @@
+"""
+Two-stage approximate HAC for corpora too large for exact HAC.
+Embeddings are first compressed into micro-clusters with mini-batch k-means, HAC then runs on the
+micro-cluster centroids and the result is expanded back into a regular linkage table over all
+documents, so hac_to_treemap, the summarizers and build_tree_map work unchanged
+"""
+import time
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import cophenet, fcluster
+from scipy.spatial.distance import pdist
+
+from picture_text.src.linkage import linkage
+
+def weighted_ward_linkage(centroids, weights):
+    """
+    Ward linkage of weighted points (cluster centroids with their sizes) using the nearest-neighbour chain algorithm.
+    Merge heights follow fastcluster's ward convention, sqrt(2 * w_a * w_b / (w_a + w_b)) * |c_a - c_b|,
+    which equals the exact ward height had the points been expanded into their members
+
+    Args:
+        centroids (array): k x d matrix of centroids
+        weights (array): size of each centroid
+    Returns:
+        (k-1) x 4 linkage table, counts are in centroid units
+
+    >>> weighted_ward_linkage(np.array([[0.], [1.], [10.]]), np.array([1, 1, 2]))
+    array([[ 0.        ,  1.        ,  1.        ,  2.        ],
+           [ 2.        ,  3.        , 13.43502884,  3.        ]])
+    """
+    centroids = np.array(centroids, dtype=np.float64)
+    weights = np.array(weights, dtype=np.float64)
+    k = len(centroids)
+    active = np.ones(k, dtype=bool)
+    merges = []
+    chain = []
+    while len(merges) < k - 1:
+        if len(chain) == 0:
+            chain.append(int(np.argmax(active)))
+        a = chain[-1]
+        w = weights[a] * weights / (weights[a] + weights)
+        cost = w * ((centroids - centroids[a]) ** 2).sum(axis=1)
+        cost[~active] = np.inf
+        cost[a] = np.inf
+        # Prefer the previous chain element on ties so the chain always terminates
+        if len(chain) > 1 and cost[chain[-2]] <= cost.min():
+            b = chain[-2]
+        else:
+            b = int(np.argmin(cost))
+        if len(chain) > 1 and b == chain[-2]:
+            chain = chain[:-2]
+            merges.append((a, b, np.sqrt(2 * cost[b])))
+            # Slot a now holds the merged cluster
+            total = weights[a] + weights[b]
+            centroids[a] = (weights[a] * centroids[a] + weights[b] * centroids[b]) / total
+            weights[a] = total
+            active[b] = False
+        else:
+            chain.append(b)
+
+    # Order merges by height and relabel slots into scipy cluster ids
+    merges.sort(key=lambda m: m[2])
+    label = list(range(k))
+    size = [1] * k
+    parent = list(range(k))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    res = np.zeros((k - 1, 4))
+    for step, (a, b, dist) in enumerate(merges):
+        ra, rb = find(a), find(b)
+        la, lb = sorted([label[ra], label[rb]])
+        res[step] = [la, lb, dist, size[ra] + size[rb]]
+        parent[rb] = ra
+        label[ra] = k + step
+        size[ra] += size[rb]
+    return res
+
+def expand_linkage(X, micro_labels, top_linkage, method='ward', metric='euclidean'):
+    """
+    Expands a linkage over micro-clusters into a linkage table over all documents.
+    Each micro-cluster gets an exact HAC over its own members, with heights capped at the height where the
+    micro-cluster is first merged so the tree stays monotonic; micro-cluster merges come last so the top
+    of the tree (and therefore the top treemap layers) follows the centroid linkage
+
+    Args:
+        X (array): N x d embedding matrix
+        micro_labels (array): micro-cluster index 0..k-1 of each document, every index must be used
+        top_linkage (array): (k-1) x 4 linkage table over the micro-clusters
+        method (string, optional): HAC method used within micro-clusters, defaults to 'ward'
+        metric (string, optional): distance metric used within micro-clusters, defaults to 'euclidean'
+    Returns:
+        (N-1) x 4 linkage table over all documents with correct leaf counts
+
+    >>> X = np.array([[0.], [0.1], [5.], [5.2], [5.1]])
+    >>> expand_linkage(X, np.array([0, 0, 1, 1, 1]), np.array([[0, 1, 5., 2]]))
+    array([[0.        , 1.        , 0.1       , 2.        ],
+           [2.        , 4.        , 0.1       , 2.        ],
+           [3.        , 6.        , 0.17320508, 3.        ],
+           [5.        , 7.        , 5.        , 5.        ]])
+    >>> expand_linkage(np.array([[1., 0.], [0., 1.], [1., 1.]]), np.array([0, 0, 1]), np.array([[0, 1, 2., 2]]), method='average', metric='cosine')[0]
+    array([0., 1., 1., 2.])
+    """
+    n = len(micro_labels)
+    k = len(top_linkage) + 1
+    top_linkage = np.asarray(top_linkage, dtype=np.float64)
+
+    # Height at which each micro-cluster is first merged, caps heights inside it
+    cap = np.full(k, np.inf)
+    for row in top_linkage:
+        for child in row[:2].astype(int):
+            if child < k:
+                cap[child] = row[2]
+
+    order = np.argsort(micro_labels, kind='stable')
+    bounds = np.searchsorted(micro_labels[order], np.arange(k + 1))
+    rows = []
+    node = np.empty(k, dtype=np.int64)
+    next_id = n
+    for j in range(k):
+        members = order[bounds[j]:bounds[j+1]]
+        if len(members) == 1:
+            node[j] = members[0]
+            continue
+        if len(members) == 2:
+            # Any method merges two points at their distance under metric
+            sub = np.array([[0, 1, pdist(X[members], metric=metric)[0], 2]])
+        else:
+            sub, _ = linkage(X[members], method=method, metric=metric)
+        ids = np.concatenate([members, next_id + np.arange(len(sub))])
+        sub_rows = np.column_stack([ids[sub[:,0].astype(int)], ids[sub[:,1].astype(int)],
+                                    np.minimum(sub[:,2], cap[j]), sub[:,3]])
+        rows.append(sub_rows)
+        next_id += len(sub)
+        node[j] = next_id - 1
+
+    ids = np.concatenate([node, next_id + np.arange(len(top_linkage))])
+    counts = np.bincount(micro_labels, minlength=k).astype(np.float64)
+    top_counts = np.concatenate([counts, np.zeros(len(top_linkage))])
+    for i, row in enumerate(top_linkage):
+        top_counts[k + i] = top_counts[int(row[0])] + top_counts[int(row[1])]
+    rows.append(np.column_stack([ids[top_linkage[:,0].astype(int)], ids[top_linkage[:,1].astype(int)],
+                                 top_linkage[:,2], top_counts[k:]]))
+    res = np.concatenate(rows) if rows else np.zeros((0, 4))
+    assert(len(res) == n - 1)
+    return res
+
+def approximate_linkage(X, n_micro=2000, method='ward', metric='euclidean', batch_size=4096, random_state=0):
+    """
+    Two-stage approximate HAC: mini-batch k-means into n_micro micro-clusters, HAC over the
+    micro-cluster centroids (weighted by size for ward) and expansion to a linkage over all documents
+
+    Args:
+        X (list or array): N x d embedding matrix
+        n_micro (int, optional): number of micro-clusters, defaults to 2000
+        method (string, optional): HAC method, defaults to 'ward'
+        metric (string, optional): distance metric, defaults to 'euclidean'
+        batch_size (int, optional): mini-batch size of k-means, defaults to 4096
+        random_state (int, optional): seed of k-means, defaults to 0
+    Returns:
+        (N-1) x 4 linkage table over all documents
+
+    >>> rng = np.random.RandomState(0)
+    >>> X = np.concatenate([rng.normal(0, 1, (300, 4)), rng.normal(20, 1, (200, 4))])
+    >>> Z = approximate_linkage(X, n_micro=20)
+    >>> Z.shape, int(Z[-1, 3])
+    ((499, 4), 500)
+    >>> sorted(np.bincount(fcluster(Z, 2, 'maxclust')).tolist())
+    [0, 200, 300]
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    X = np.asarray(X)
+    n = len(X)
+    if n_micro >= n:
+        return linkage(X, method=method, metric=metric)[0]
+    km = MiniBatchKMeans(n_clusters=n_micro, batch_size=batch_size, random_state=random_state, n_init=1)
+    micro_labels = km.fit_predict(X)
+    # Drop micro-clusters that ended up empty
+    used, micro_labels = np.unique(micro_labels, return_inverse=True)
+    centroids = km.cluster_centers_[used]
+    weights = np.bincount(micro_labels)
+    if len(used) == 1:
+        top_linkage = np.zeros((0, 4))
+    elif method == 'ward' and metric == 'euclidean':
+        top_linkage = weighted_ward_linkage(centroids, weights)
+    else:
+        top_linkage, _ = linkage(centroids, method=method, metric=metric)
+    return expand_linkage(X, micro_labels, top_linkage, method=method, metric=metric)
+
+def approximation_report(X, n_micro=2000, sample_sizes=[1000, 5000, 10000], nr_clusters=[3, 10, 30],
+                            method='ward', metric='euclidean', random_state=0):
+    """
+    Compares approximate against exact HAC on random samples where exact HAC is feasible
+
+    Args:
+        X (list or array): N x d embedding matrix to sample from
+        n_micro (int or float, optional): number of micro-clusters, a float below 1 is taken as a share of each sample size, defaults to 2000
+        sample_sizes (list, optional): sample sizes to compare on, defaults to [1000, 5000, 10000]
+        nr_clusters (list, optional): flat cuts compared with the adjusted rand index, defaults to [3, 10, 30]
+        method (string, optional): HAC method, defaults to 'ward'
+        metric (string, optional): distance metric, defaults to 'euclidean'
+        random_state (int, optional): seed for sampling and k-means, defaults to 0
+    Returns:
+        DataFrame with one row per sample size: n_micro, exact and approximate seconds,
+        cophenetic correlation between the two trees and adjusted rand index of each flat cut
+    """
+    from sklearn.metrics import adjusted_rand_score
+    X = np.asarray(X)
+    rng = np.random.RandomState(random_state)
+    res = []
+    for size in sample_sizes:
+        if size > len(X):
+            continue
+        sample = X[rng.choice(len(X), size, replace=False)]
+        micro = int(n_micro * size) if n_micro < 1 else min(int(n_micro), size)
+        t0 = time.perf_counter()
+        exact, _ = linkage(sample, method=method, metric=metric)
+        t1 = time.perf_counter()
+        approx = approximate_linkage(sample, n_micro=micro, method=method, metric=metric, random_state=random_state)
+        t2 = time.perf_counter()
+        row = {
+            'sample_size': size,
+            'n_micro': micro,
+            'exact_secs': t1 - t0,
+            'approx_secs': t2 - t1,
+            'cophenetic_corr': np.corrcoef(cophenet(exact), cophenet(approx))[0, 1],
+        }
+        for k in nr_clusters:
+            row[f'ari_{k}'] = adjusted_rand_score(fcluster(exact, k, 'maxclust'), fcluster(approx, k, 'maxclust'))
+        res.append(row)
+    return pd.DataFrame(res)
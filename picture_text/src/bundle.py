@@ -0,0 +1,275 @@
+"""
+Versioned on-disk bundle of a fitted PictureText. A bundle is a directory holding
+    - meta.json: format version, HAC settings, sizes, node table columns and a content hash
+    - embeddings.npy: float32 embeddings, loaded memory-mapped
+    - linkage.npy: the linkage table
+    - tree/: the HACTree arrays, so the tree is not rebuilt on load
+    - text.bin / text_offsets.npy: utf-8 encoded documents back to back and their offsets
+    - nodes/: optional hac_to_treemap node table, one typed array per column
+Nothing is parsed or copied on load, so loading stays fast for millions of documents and pages are only read when used
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from picture_text.src.hac_tools import HACTree, HACSubtree
+
+FORMAT_VERSION = 1
+# Columns of the node table not stored: cluster_table is rebuilt from the tree on load, members are read from it on demand
+DERIVED_COLUMNS = ['cluster_members', 'cluster_table']
+ROOT_PARENT = 'Full'
+
+class TextColumn():
+    """
+    Read-only sequence of strings stored as utf-8 bytes and offsets, strings are decoded on access
+
+    >>> col = TextColumn(np.frombuffer('ab€'.encode(), dtype=np.uint8), np.array([0, 1, 2, 5]))
+    >>> len(col), col[2], list(col)
+    (3, '€', ['a', 'b', '€'])
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return bytes(self.data[self.offsets[i]:self.offsets[i+1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def write_text(path, texts):
+    """
+    Writes texts to path.bin and path_offsets.npy
+
+    Returns:
+        sha256 hash object updated with the text bytes
+    """
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    h = hashlib.sha256()
+    with open(path + '.bin', 'wb') as f:
+        for i, t in enumerate(texts):
+            b = str(t).encode('utf-8')
+            f.write(b)
+            h.update(b)
+            offsets[i+1] = offsets[i] + len(b)
+    np.save(path + '_offsets.npy', offsets)
+    h.update(offsets.tobytes())
+    return h
+
+def read_text(path):
+    """
+    Returns a TextColumn over path.bin and path_offsets.npy, memory-mapped
+    """
+    offsets = np.load(path + '_offsets.npy', mmap_mode='r')
+    if offsets[-1] == 0:
+        data = np.zeros(0, dtype=np.uint8)
+    else:
+        data = np.memmap(path + '.bin', dtype=np.uint8, mode='r')
+    return TextColumn(data, offsets)
+
+def _write_embeddings(path, embeddings, chunk_size=65536):
+    """
+    Writes embeddings as float32 a chunk at a time, returns the hash of the written values
+    """
+    n = len(embeddings)
+    dim = len(embeddings[0]) if n else 0
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, dim))
+    h = hashlib.sha256()
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        out[start:start + len(chunk)] = chunk
+        h.update(chunk.tobytes())
+    out.flush()
+    del out
+    return h.hexdigest()
+
+def _hash_embeddings(embeddings, chunk_size=65536):
+    h = hashlib.sha256()
+    for start in range(0, len(embeddings), chunk_size):
+        h.update(np.ascontiguousarray(embeddings[start:start + chunk_size], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+def content_hash(parts):
+    """
+    Combines the hashes of the bundle parts into the bundle content hash
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def save_node_table(path, df_res):
+    """
+    Stores a hac_to_treemap node table column by column in path, derived columns are skipped
+
+    Returns:
+        list of [column, kind] with kind 'text' or the numpy dtype
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = []
+    for col in df_res.columns:
+        if col in DERIVED_COLUMNS:
+            continue
+        values = df_res[col]
+        if col == 'parent':
+            values = values.replace(ROOT_PARENT, -1)
+        try:
+            arr = np.asarray(values.tolist())
+        except ValueError:
+            arr = np.asarray(values.astype(str).tolist())
+        if arr.dtype.kind in 'biuf':
+            np.save(os.path.join(path, f'{col}.npy'), arr)
+            columns.append([col, arr.dtype.str])
+        else:
+            write_text(os.path.join(path, col), values.tolist())
+            columns.append([col, 'text'])
+    return columns
+
+def load_node_table(path, tree=None):
+    """
+    Loads the node table of a bundle, None if it was saved without one
+
+    Args:
+        path (string): bundle directory
+        tree (HACTree, optional): tree of the bundle, when given cluster_table is rebuilt from it, defaults to None
+    Returns:
+        DataFrame in the hac_to_treemap form
+    """
+    meta = read_meta(path)
+    if meta['node_columns'] is None:
+        return None
+    nodes = os.path.join(path, 'nodes')
+    data = {}
+    for col, kind in meta['node_columns']:
+        if kind == 'text':
+            data[col] = list(read_text(os.path.join(nodes, col)))
+        else:
+            data[col] = np.load(os.path.join(nodes, f'{col}.npy'))
+    df_res = pd.DataFrame(data)
+    if 'parent' in df_res:
+        df_res['parent'] = df_res['parent'].astype(object).where(df_res['parent'] >= 0, ROOT_PARENT)
+    if tree is not None:
+        df_res['cluster_table'] = [HACSubtree(tree, int(i)) for i in df_res['id']]
+    return df_res
+
+def read_meta(path):
+    """
+    Reads and checks the meta.json of a bundle
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported bundle format version {meta.get('format_version')} in {path}, expected {FORMAT_VERSION}")
+    return meta
+
+def save_bundle(pt, path, df_res=None):
+    """
+    Saves a fitted PictureText to a bundle directory. Encoders are not saved
+
+    Args:
+        pt (PictureText): fitted PictureText, i.e. with embeddings and linkage table
+        path (string): bundle directory, created if missing
+        df_res (DataFrame, optional): hac_to_treemap node table (with labels if summarized) to store along, defaults to None
+    Returns:
+        content hash of the bundle (string)
+    """
+    assert(np.all(pt.linkage_table!=None))
+    os.makedirs(path, exist_ok=True)
+    linkage_table = np.asarray(pt.linkage_table, dtype=np.float64)
+    np.save(os.path.join(path, 'linkage.npy'), linkage_table)
+    os.makedirs(os.path.join(path, 'tree'), exist_ok=True)
+    tree = pt.tree if pt.tree is not None and pt.layout_cache.source is pt.linkage_table else HACTree(linkage_table)
+    for name in HACTree.ARRAYS:
+        np.save(os.path.join(path, 'tree', f'{name}.npy'), getattr(tree, name))
+    parts = {
+        'linkage': hashlib.sha256(linkage_table.tobytes()).hexdigest(),
+        'embeddings': _write_embeddings(os.path.join(path, 'embeddings.npy'), pt.txt_embeddings),
+        'text': write_text(os.path.join(path, 'text'), pt.txt).hexdigest(),
+    }
+    node_columns = None
+    if df_res is not None:
+        node_columns = save_node_table(os.path.join(path, 'nodes'), df_res)
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_docs': len(pt.txt),
+        'dim': int(np.shape(pt.txt_embeddings)[1]) if len(pt.txt) else 0,
+        'hac_method': pt.hac_method,
+        'hac_metric': pt.hac_metric,
+        'linkage_engine': pt.linkage_engine,
+        'approx_clusters': pt.approx_clusters,
+        'node_columns': node_columns,
+        'parts': parts,
+        'content_hash': content_hash(parts),
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta['content_hash']
+
+def load_bundle(path, verify=False):
+    """
+    Loads a bundle saved by save_bundle. Embeddings, text and tree arrays stay memory-mapped
+
+    Args:
+        path (string): bundle directory
+        verify (bool, optional): recompute the content hash and raise a ValueError on mismatch, reads the whole bundle, defaults to False
+    Returns:
+        PictureText
+
+    >>> import tempfile
+    >>> from picture_text.picture_text import PictureText
+    >>> pt = PictureText(['a', 'b', 'c', 'd'])
+    >>> pt([[1, 2], [4, 5], [10, 0], [9, 1]])
+    >>> path = os.path.join(tempfile.mkdtemp(), 'bundle')
+    >>> bundle_hash = save_bundle(pt, path, pt.hac_to_treemap(pt.linkage_table, depth=2))
+    >>> pt2 = load_bundle(path, verify=True)
+    >>> list(pt2.txt), pt2.txt_embeddings.dtype, pt2.hac_method, np.array_equal(pt2.linkage_table, pt.linkage_table)
+    (['a', 'b', 'c', 'd'], dtype('float32'), 'ward', True)
+    >>> df_res = load_node_table(path, pt2.tree)
+    >>> df_res[['id', 'parent', 'value']]
+       id parent  value
+    0   0   Full      1
+    1   1   Full      1
+    2   4   Full      2
+    3   2      4      1
+    4   3      4      1
+    >>> [t.members() for t in df_res['cluster_table']]
+    [[0], [1], [2, 3], [2], [3]]
+    >>> read_meta(path)['content_hash'] == bundle_hash
+    True
+    """
+    from picture_text.picture_text import PictureText
+    meta = read_meta(path)
+    pt = PictureText(read_text(os.path.join(path, 'text')))
+    pt.txt_embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r')
+    pt.linkage_table = np.load(os.path.join(path, 'linkage.npy'), mmap_mode='r')
+    pt.hac_method = meta['hac_method']
+    pt.hac_metric = meta['hac_metric']
+    pt.linkage_engine = meta['linkage_engine']
+    pt.approx_clusters = meta['approx_clusters']
+    pt.built_size = meta['n_docs']
+    pt.content_hash = meta['content_hash']
+    if verify:
+        text = os.path.join(path, 'text')
+        h = hashlib.sha256()
+        with open(text + '.bin', 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        h.update(np.load(text + '_offsets.npy').tobytes())
+        parts = {
+            'linkage': hashlib.sha256(np.asarray(pt.linkage_table).tobytes()).hexdigest(),
+            'embeddings': _hash_embeddings(pt.txt_embeddings),
+            'text': h.hexdigest(),
+        }
+        if content_hash(parts) != meta['content_hash']:
+            raise ValueError(f'Bundle {path} does not match its content hash')
+    pt.tree = HACTree.from_arrays({name: np.load(os.path.join(path, 'tree', f'{name}.npy'), mmap_mode='r')
+                                    for name in HACTree.ARRAYS})
+    pt.layout_cache.clear(source=pt.linkage_table)
+    return pt
@@ -0,0 +1,147 @@
+"""
+Lazy loading of app collections: a collection is loaded the first time it is requested and the least
+recently used ones are evicted once the loaded collections exceed a memory cap
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+class CollectionManager():
+    """
+    Thread-safe least-recently-used cache of loaded collections. Concurrent first requests for the same
+    collection share one load
+    """
+    def __init__(self, loader, max_bytes=None, max_items=None, sizeof=None, on_evict=None):
+        """
+        Args:
+            loader (object): function of the form collection = loader(name)
+            max_bytes (int, optional): memory cap of the loaded collections, the most recent one is always kept, defaults to None (no cap)
+            max_items (int, optional): maximal number of loaded collections, defaults to None (no limit)
+            sizeof (object, optional): function of the form nr_bytes = sizeof(collection) used for max_bytes, defaults to None (0 bytes)
+            on_evict (object, optional): function called as on_evict(name) after a collection was evicted, e.g. to drop
+                caches derived from it, defaults to None
+
+        >>> evicted = []
+        >>> manager = CollectionManager(lambda name: name.upper(), max_bytes=2, sizeof=len, on_evict=evicted.append)
+        >>> manager.get('a'), manager.get('b'), manager.get('a'), manager.get('cc')
+        ('A', 'B', 'A', 'CC')
+        >>> manager.loaded(), evicted
+        (['cc'], ['b', 'a'])
+        >>> {k: v for k, v in manager.stats().items() if k != 'load_secs'}
+        {'hits': 1, 'misses': 3, 'shared_loads': 0, 'evictions': 2, 'loaded': 1, 'loaded_bytes': 2}
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = sizeof or (lambda collection: 0)
+        self.on_evict = on_evict
+        self.collections = OrderedDict()
+        self.sizes = {}
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared_loads = 0
+        self.evictions = 0
+        self.load_secs = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns collection name, loading it if needed
+
+        Args:
+            name (string): collection name passed to the loader
+        Returns:
+            collection
+        """
+        with self._lock:
+            if name in self.collections:
+                self.hits += 1
+                self.collections.move_to_end(name)
+                return self.collections[name]
+            if name in self.loading:
+                self.shared_loads += 1
+                future = self.loading[name]
+                owner = False
+            else:
+                self.misses += 1
+                future = Future()
+                self.loading[name] = future
+                owner = True
+        if not owner:
+            return future.result()
+
+        t0 = time.perf_counter()
+        try:
+            collection = self.loader(name)
+            size = self.sizeof(collection)
+        except BaseException as e:
+            with self._lock:
+                del self.loading[name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self.load_secs[name] = time.perf_counter() - t0
+            self.collections[name] = collection
+            self.sizes[name] = size
+            del self.loading[name]
+            evicted = self._evict()
+        future.set_result(collection)
+        self._notify(evicted)
+        return collection
+
+    def _evict(self):
+        """
+        Evicts least recently used collections while over the caps, the caller holds the lock. Returns the evicted names
+        """
+        evicted = []
+        while len(self.collections) > 1 and (
+                (self.max_items is not None and len(self.collections) > self.max_items) or
+                (self.max_bytes is not None and sum(self.sizes.values()) > self.max_bytes)):
+            name, _ = self.collections.popitem(last=False)
+            del self.sizes[name]
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def _notify(self, evicted):
+        # Called outside the lock, so on_evict may use the manager
+        if self.on_evict is not None:
+            for name in evicted:
+                self.on_evict(name)
+
+    def evict(self, name):
+        """
+        Drops collection name if it is loaded, e.g. after it was rebuilt
+        """
+        with self._lock:
+            evicted = []
+            if self.collections.pop(name, None) is not None:
+                del self.sizes[name]
+                self.evictions += 1
+                evicted.append(name)
+        self._notify(evicted)
+
+    def loaded(self):
+        """
+        Returns the names of loaded collections, least recently used first
+        """
+        with self._lock:
+            return list(self.collections.keys())
+
+    def stats(self):
+        """
+        Returns hit, miss, shared load (requests that waited for another request's load), eviction counts,
+        loaded collections and bytes, and the seconds each collection took to load
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_loads': self.shared_loads,
+                'evictions': self.evictions,
+                'loaded': len(self.collections),
+                'loaded_bytes': sum(self.sizes.values()),
+                'load_secs': dict(self.load_secs),
+            }
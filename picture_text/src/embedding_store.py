@@ -0,0 +1,171 @@
+"""
+On-disk embedding store keyed by text hash and encoder identity.
+Vectors are written in append-only .npy shards and read back memory-mapped, so
+re-encoding an overlapping corpus only pays for the texts not seen before
+"""
+import functools
+import glob
+import inspect
+import os
+import numpy as np
+
+from picture_text.src.utils import hash_text, makedirs
+
+def encoder_identity(encoder):
+    """
+    Returns a stable string identifying an encoder function, used to keep embeddings of different encoders apart.
+    Lambdas and local functions share their qualified name with every other lambda or local function of the same scope,
+    and callable objects share theirs with every other instance of their class, so they cannot be told apart and a
+    ValueError is raised, pass an explicit encoder_id for them instead. Callable objects can provide their own
+    identity through an encoder_id attribute (see ParallelEncoder)
+
+    Args:
+        encoder (object): encoder function, functools.partial objects include their bound arguments
+    Returns:
+        identity string
+
+    >>> encoder_identity(hash_text)
+    'picture_text.src.utils.hash_text'
+    >>> encoder_identity(functools.partial(hash_text, 'x'))
+    "picture_text.src.utils.hash_text('x')"
+    >>> encoder_identity(lambda x: x)
+    Traceback (most recent call last):
+        ...
+    ValueError: Cannot derive a unique identity for encoder <lambda>, pass an explicit encoder_id
+    >>> class Encoder():
+    ...     def __call__(self, text_list):
+    ...         return [[1]] * len(text_list)
+    >>> encoder_identity(Encoder())
+    Traceback (most recent call last):
+        ...
+    ValueError: Cannot derive a unique identity for encoder instance of Encoder, pass an explicit encoder_id
+    >>> encoder = Encoder()
+    >>> encoder.encoder_id = 'ones'
+    >>> encoder_identity(encoder)
+    'ones'
+    """
+    if getattr(encoder, 'encoder_id', None) is not None:
+        return encoder.encoder_id
+    if isinstance(encoder, functools.partial):
+        args = [repr(a) for a in encoder.args] + [f'{k}={v!r}' for k, v in sorted(encoder.keywords.items())]
+        return f"{encoder_identity(encoder.func)}({', '.join(args)})"
+    if not hasattr(encoder, '__qualname__') or inspect.ismethod(encoder):
+        # Instances and their bound methods: the class name is the same for all instances
+        raise ValueError(f'Cannot derive a unique identity for encoder instance of {type(encoder).__qualname__}, pass an explicit encoder_id')
+    module = encoder.__module__
+    name = encoder.__qualname__
+    if '<lambda>' in name or '<locals>' in name:
+        raise ValueError(f'Cannot derive a unique identity for encoder {name}, pass an explicit encoder_id')
+    return f'{module}.{name}'
+
+class EmbeddingStore():
+    """
+    Content-addressed embedding cache. Layout on disk:
+        path/<hash of encoder id>/encoder.txt                 readable encoder id
+        path/<hash of encoder id>/shard_00000.npy            float32 vectors
+        path/<hash of encoder id>/shard_00000.keys.npy       text hashes, one per vector row
+    A shard only counts once its keys file exists, so an interrupted write is ignored on the next open.
+    The store assumes a single writer per directory.
+    """
+    def __init__(self, path):
+        """
+        Initialize store
+
+        Args:
+            path (string): Root directory of the store, created if missing
+        """
+        self.path = path
+        self._spaces = {}
+        makedirs([path])
+
+    def encode(self, text_list, encoder, encoder_id=None):
+        """
+        Returns embeddings for text_list, encoding only the texts missing from the store
+
+        Args:
+            text_list (list): list of strings to embed
+            encoder (object): encoder function of the form embeddings = encoder(text_list)
+            encoder_id (string, optional): identity of the encoder, required for lambdas and local functions, defaults to None which derives it via encoder_identity
+        Returns:
+            float32 matrix of embeddings, one row per string in text_list
+
+        >>> import tempfile
+        >>> calls = []
+        >>> def toy_encoder(text_list):
+        ...     calls.append(list(text_list))
+        ...     return [[len(t), 1.] for t in text_list]
+        >>> store = EmbeddingStore(tempfile.mkdtemp())
+        >>> store.encode(['a', 'bb', 'a'], toy_encoder)
+        array([[1., 1.],
+               [2., 1.],
+               [1., 1.]], dtype=float32)
+        >>> store.encode(['ccc', 'bb'], toy_encoder)
+        array([[3., 1.],
+               [2., 1.]], dtype=float32)
+        >>> calls
+        [['a', 'bb'], ['ccc']]
+
+        Lambdas need an explicit encoder_id, so two of them never share cached vectors
+        >>> store.encode(['a'], lambda x: [[0., 0.]] * len(x))
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot derive a unique identity for encoder <lambda>, pass an explicit encoder_id
+        >>> store.encode(['a'], lambda x: [[0., 0.]] * len(x), encoder_id='zeros'), store.encode(['a'], lambda x: [[5., 5.]] * len(x), encoder_id='fives')
+        (array([[0., 0.]], dtype=float32), array([[5., 5.]], dtype=float32))
+        """
+        encoder_id = encoder_identity(encoder) if encoder_id is None else encoder_id
+        space = self._space(encoder_id)
+        hashes = [hash_text(t) for t in text_list]
+
+        # Encode unseen texts once each and append them as a new shard
+        missing = {}
+        for i, h in enumerate(hashes):
+            if h not in space['index'] and h not in missing:
+                missing[h] = i
+        if missing:
+            new_txt = [text_list[i] for i in missing.values()]
+            new_embeddings = np.asarray(encoder(new_txt), dtype=np.float32)
+            assert(len(new_embeddings)==len(new_txt))
+            self._append_shard(space, list(missing.keys()), new_embeddings)
+
+        if len(hashes) == 0:
+            return np.zeros((0, space['dim'] or 0), dtype=np.float32)
+        res = np.empty((len(hashes), space['dim']), dtype=np.float32)
+        locations = np.array([space['index'][h] for h in hashes], dtype=np.int64).reshape(-1, 2)
+        for shard in np.unique(locations[:,0]):
+            pos = np.where(locations[:,0]==shard)[0]
+            res[pos] = space['shards'][shard][locations[pos,1]]
+        return res
+
+    def __len__(self):
+        return sum(len(space['index']) for space in self._spaces.values())
+
+    def _space(self, encoder_id):
+        """
+        Opens (and caches) the directory holding the embeddings of one encoder
+        """
+        if encoder_id in self._spaces:
+            return self._spaces[encoder_id]
+        path = os.path.join(self.path, hash_text(encoder_id))
+        makedirs([path])
+        with open(os.path.join(path, 'encoder.txt'), 'w') as f:
+            f.write(encoder_id)
+        space = {'path': path, 'index': {}, 'shards': [], 'dim': None}
+        for keys_file in sorted(glob.glob(os.path.join(path, 'shard_*.keys.npy'))):
+            vectors = np.load(keys_file.replace('.keys.npy', '.npy'), mmap_mode='r')
+            self._register_shard(space, np.load(keys_file), vectors)
+        self._spaces[encoder_id] = space
+        return space
+
+    def _append_shard(self, space, keys, embeddings):
+        shard_file = os.path.join(space['path'], f"shard_{len(space['shards']):05d}.npy")
+        np.save(shard_file, embeddings)
+        np.save(shard_file.replace('.npy', '.keys.npy'), np.array(keys))
+        self._register_shard(space, keys, np.load(shard_file, mmap_mode='r'))
+
+    def _register_shard(self, space, keys, vectors):
+        shard = len(space['shards'])
+        space['shards'].append(vectors)
+        space['dim'] = vectors.shape[1]
+        for row, h in enumerate(keys):
+            space['index'][str(h)] = (shard, row)
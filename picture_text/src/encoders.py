@@ -0,0 +1,537 @@
+"""
+Helpers around text encoders: a process-wide cache of loaded models so repeated
+encodes reuse a warm model instead of deserializing the weights again,
+chunked encoding of large corpora into a preallocated matrix, a
+multi-process encoding pool for CPU-only machines and length-bucketed batching
+"""
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class ModelCache():
+    """
+    Least-recently-used registry of loaded encoder models keyed by model reference and device
+    """
+    def __init__(self, max_size=2):
+        """
+        Initialize cache
+
+        Args:
+            max_size (int, optional): Maximal number of models kept resident, defaults to 2
+
+        >>> cache = ModelCache(max_size=2)
+        >>> cache.get('a', loader=lambda ref, device: ref.upper())
+        'A'
+        >>> cache.get('b', loader=lambda ref, device: ref.upper())
+        'B'
+        >>> cache.get('a', loader=lambda ref, device: 'reloaded')
+        'A'
+        >>> cache.get('c', loader=lambda ref, device: ref.upper())
+        'C'
+        >>> cache.keys()
+        [('a', None), ('c', None)]
+        >>> cache.hits, cache.misses
+        (1, 3)
+        """
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, reference, loader, device=None):
+        """
+        Returns the model for (reference, device), loading it with loader if it is not resident
+
+        Args:
+            reference (string): Model reference, e.g. the pretrained model name
+            loader (object): Function of the form model = loader(reference, device), called on a miss
+            device (string, optional): Device the model is loaded on, defaults to None (library default)
+        Returns:
+            model
+        """
+        key = (reference, device)
+        with self._lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+            self.misses += 1
+            model = loader(reference, device)
+            self.models[key] = model
+            self._evict()
+            return model
+
+    def resize(self, max_size):
+        """
+        Changes the number of models kept resident, evicting least recently used ones if needed
+
+        Args:
+            max_size (int): Maximal number of models kept resident
+        """
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        """
+        Drops all resident models
+        """
+        with self._lock:
+            self.models.clear()
+
+    def keys(self):
+        return list(self.models.keys())
+
+    def _evict(self):
+        while len(self.models) > max(self.max_size, 0):
+            self.models.popitem(last=False)
+
+model_cache = ModelCache(max_size=int(os.environ.get('PT_MODEL_CACHE_SIZE', 2)))
+
+def load_sentence_transformer(pretrained_reference, device=None):
+    """
+    Loads a SentenceTransformer model, see https://www.sbert.net
+
+    Args:
+        pretrained_reference (string): the pretrained model to use inside SentenceTransformer
+        device (string, optional): device to load the model on, e.g. 'cpu' or 'cuda', defaults to None
+    Returns:
+        SentenceTransformer model
+    """
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(pretrained_reference, device=device)
+
+def get_sentence_transformer(pretrained_reference, device=None, cache=None):
+    """
+    Returns a warm SentenceTransformer model from the process-wide cache, loading it on first use
+
+    Args:
+        pretrained_reference (string): the pretrained model to use inside SentenceTransformer
+        device (string, optional): device to load the model on, defaults to None
+        cache (ModelCache, optional): cache to use, defaults to the process-wide model_cache
+    Returns:
+        SentenceTransformer model
+    """
+    cache = model_cache if cache is None else cache
+    return cache.get(pretrained_reference, loader=load_sentence_transformer, device=device)
+
+def encode_stream(texts, encoder, n_docs=None, chunk_size=1024, out_path=None, progress=False):
+    """
+    Encodes an iterable of strings in fixed-size chunks straight into a preallocated float32 matrix,
+    so only one chunk of raw text and its intermediate embeddings are held at any time
+
+    Args:
+        texts (iterable): strings to embed, can be a generator
+        encoder (object): encoder function of the form embeddings = encoder(text_list)
+        n_docs (int, optional): number of strings in texts, needed when texts has no len(), defaults to None
+        chunk_size (int, optional): number of strings passed to the encoder at a time, defaults to 1024
+        out_path (string, optional): .npy file to write the matrix to as a memory-map, defaults to None which keeps it in RAM
+        progress (bool or object, optional): True logs progress after each chunk, a function of the form progress(nr_done, nr_total) is called instead, defaults to False
+    Returns:
+        float32 matrix (numpy array or memmap) of embeddings, one row per string
+
+    >>> encode_stream((str(i) * i for i in range(1, 6)), lambda x: [[len(t)] for t in x], n_docs=5, chunk_size=2, progress=True)
+    array([[1.],
+           [2.],
+           [3.],
+           [4.],
+           [5.]], dtype=float32)
+    """
+    if n_docs is None:
+        try:
+            n_docs = len(texts)
+        except TypeError:
+            raise ValueError('n_docs is required when texts is a generator or iterator')
+    texts = iter(texts)
+    res = None
+    done = 0
+    while True:
+        chunk = list(itertools.islice(texts, chunk_size))
+        if len(chunk) == 0:
+            break
+        if done + len(chunk) > n_docs:
+            raise ValueError(f'Received more than n_docs={n_docs} texts')
+        chunk_embeddings = np.asarray(encoder(chunk), dtype=np.float32)
+        assert(len(chunk_embeddings)==len(chunk))
+        if res is None:
+            shape = (n_docs, chunk_embeddings.shape[1])
+            if out_path is None:
+                res = np.empty(shape, dtype=np.float32)
+            else:
+                res = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=shape)
+        res[done:done+len(chunk)] = chunk_embeddings
+        done += len(chunk)
+        del chunk, chunk_embeddings
+        if callable(progress):
+            progress(done, n_docs)
+        elif progress:
+            logger.info('Encoded %d/%d texts', done, n_docs)
+    if done != n_docs:
+        raise ValueError(f'Expected n_docs={n_docs} texts, received {done}')
+    if res is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    if out_path is not None:
+        res.flush()
+    return res
+
+# Model loaded once per pool worker, see _init_worker
+_worker_model = None
+
+def _init_worker(loader, reference, device, nr_threads):
+    """
+    Pool initializer: limits intra-op threads so workers do not oversubscribe cores and loads the model once
+    """
+    global _worker_model
+    if nr_threads:
+        try:
+            import torch
+            torch.set_num_threads(nr_threads)
+        except ImportError:
+            pass
+    _worker_model = loader(reference, device)
+
+def _encode_shard(args):
+    """
+    Pool task: encodes one shard and hands the result back through a shared memory block named by the parent,
+    the parent process copies it into place and unlinks the block
+    """
+    start, text_list, batch_size, token_budget, name = args
+    if token_budget:
+        embeddings = bucketed_encode(text_list, _worker_model, token_budget=token_budget)
+    else:
+        embeddings = np.asarray(_worker_model.encode(text_list, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True), dtype=np.float32)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(embeddings.nbytes, 1))
+    try:
+        np.ndarray(embeddings.shape, dtype=np.float32, buffer=shm.buf)[:] = embeddings
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    # The parent unlinks the block, the tracker would otherwise try again when this worker exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return start, name, embeddings.shape
+
+def _unlink_shared(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+class ParallelEncoder():
+    """
+    Encoder callable which shards the text list across a pool of worker processes.
+    Each worker loads the model once and keeps it for the lifetime of the pool;
+    results come back in input order, so it is a drop-in replacement for sbert_encoder:
+
+        encoder = ParallelEncoder(processes=32)
+        pt(encoder=encoder)
+    """
+    def __init__(self, pretrained_reference='distilbert-base-nli-stsb-mean-tokens', processes=None, device=None,
+                    batch_size=16, shard_size=None, threads_per_process=1, loader=load_sentence_transformer,
+                    start_method='spawn', token_budget=None):
+        """
+        Initialize encoder, the pool itself is started on first use
+
+        Args:
+            pretrained_reference (string, optional): the pretrained model to use inside SentenceTransformer, defaults to 'distilbert-base-nli-stsb-mean-tokens'
+            processes (int, optional): number of worker processes, defaults to None which uses os.cpu_count()
+            device (string, optional): device each worker loads the model on, defaults to None
+            batch_size (int, optional): batch size used by model.encode inside each worker, defaults to 16
+            shard_size (int, optional): number of texts per pool task, defaults to None which splits the list into 4 shards per process
+            threads_per_process (int, optional): torch intra-op threads per worker, defaults to 1, None leaves the torch default
+            loader (object, optional): picklable function of the form model = loader(reference, device), defaults to load_sentence_transformer
+            start_method (string, optional): multiprocessing start method, defaults to 'spawn' which is safe with torch
+            token_budget (int, optional): when set, workers encode their shard in length-sorted batches of at most this many padded tokens (see bucketed_encode),
+                defaults to None which uses fixed batches of batch_size
+        """
+        self.pretrained_reference = pretrained_reference
+        self.processes = processes or os.cpu_count()
+        self.device = device
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.threads_per_process = threads_per_process
+        self.loader = loader
+        self.start_method = start_method
+        self.token_budget = token_budget
+        self._pool = None
+
+    @property
+    def encoder_id(self):
+        """
+        Identity used by EmbeddingStore (see encoder_identity), covers the settings that change the embeddings
+
+        >>> ParallelEncoder('all-MiniLM-L6-v2', device='cpu', token_budget=4096).encoder_id
+        "picture_text.src.encoders.ParallelEncoder('all-MiniLM-L6-v2', device='cpu', token_budget=4096)"
+        """
+        return f'{__name__}.{type(self).__qualname__}({self.pretrained_reference!r}, device={self.device!r}, token_budget={self.token_budget!r})'
+
+    def __call__(self, text_list):
+        """
+        Encodes text_list across the pool
+
+        Args:
+            text_list (list): list of strings to embed
+        Returns:
+            float32 matrix of embeddings, one row per string, in input order
+
+        When a shard fails, the remaining shards are still waited for and every shared memory block is unlinked
+        before the first error is raised
+        >>> class FailingModel():
+        ...     def encode(self, text_list, **kwargs):
+        ...         if 'bad' in text_list:
+        ...             raise ValueError('bad shard')
+        ...         return [[len(t)] for t in text_list]
+        >>> encoder = ParallelEncoder(processes=2, shard_size=1, loader=lambda reference, device: FailingModel(), start_method='fork')
+        >>> before = set(os.listdir('/dev/shm'))
+        >>> encoder(['a', 'bad', 'ccc'])
+        Traceback (most recent call last):
+            ...
+        ValueError: bad shard
+        >>> set(os.listdir('/dev/shm')) - before
+        set()
+        >>> encoder(['a', 'bb'])
+        array([[1.],
+               [2.]], dtype=float32)
+        >>> encoder.close()
+        """
+        text_list = list(text_list)
+        if len(text_list) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        shard_size = self.shard_size or max(1, -(-len(text_list) // (4 * self.processes)))
+        # Blocks are named here, so the ones left behind by failed or interrupted calls can be found and unlinked
+        prefix = f'pte{os.getpid()}_{uuid.uuid4().hex[:8]}_'
+        shards = [(start, text_list[start:start+shard_size], self.batch_size, self.token_budget, f'{prefix}{i}')
+                    for i, start in enumerate(range(0, len(text_list), shard_size))]
+        res = None
+        error = None
+        results = self.pool.imap_unordered(_encode_shard, shards)
+        try:
+            while True:
+                try:
+                    start, name, shape = next(results)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    # Keep collecting so shards still running do not create blocks after the cleanup below
+                    error = error or e
+                    continue
+                if error is not None:
+                    continue
+                shm = shared_memory.SharedMemory(name=name)
+                try:
+                    if res is None:
+                        res = np.empty((len(text_list), shape[1]), dtype=np.float32)
+                    res[start:start+shape[0]] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                finally:
+                    shm.close()
+                    shm.unlink()
+        finally:
+            for shard in shards:
+                _unlink_shared(shard[-1])
+        if error is not None:
+            raise error
+        return res
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            context = multiprocessing.get_context(self.start_method)
+            self._pool = context.Pool(self.processes, initializer=_init_worker,
+                initargs=(self.loader, self.pretrained_reference, self.device, self.threads_per_process))
+        return self._pool
+
+    def close(self):
+        """
+        Shuts the worker pool down, a new one is started if the encoder is called again
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Pools started through sbert_encoder(..., processes=N), kept alive so workers stay warm
+_parallel_encoders = {}
+
+def get_parallel_encoder(pretrained_reference, processes, device=None, token_budget=None):
+    """
+    Returns a warm ParallelEncoder for (pretrained_reference, processes, device, token_budget), starting it on first use
+
+    Args:
+        pretrained_reference (string): the pretrained model to use inside SentenceTransformer
+        processes (int): number of worker processes
+        device (string, optional): device each worker loads the model on, defaults to None
+        token_budget (int, optional): token budget of the workers' bucketed batches, defaults to None (fixed batches)
+    Returns:
+        ParallelEncoder
+    """
+    key = (pretrained_reference, processes, device, token_budget)
+    if key not in _parallel_encoders:
+        _parallel_encoders[key] = ParallelEncoder(pretrained_reference, processes=processes, device=device, token_budget=token_budget)
+    return _parallel_encoders[key]
+
+class BatchStats():
+    """
+    Accumulates padding and throughput statistics of bucketed encoding, to tune the token budget
+    """
+    def __init__(self):
+        self.nr_texts = 0
+        self.nr_batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.
+
+    def add(self, lengths, seconds):
+        """
+        Records one batch
+
+        Args:
+            lengths (list): token length of each text in the batch
+            seconds (float): time taken to encode the batch
+        """
+        self.nr_texts += len(lengths)
+        self.nr_batches += 1
+        self.real_tokens += int(sum(lengths))
+        self.padded_tokens += int(max(lengths)) * len(lengths)
+        self.seconds += seconds
+
+    @property
+    def padding_efficiency(self):
+        """
+        Share of the encoded token slots holding real tokens rather than padding
+        """
+        return self.real_tokens / self.padded_tokens if self.padded_tokens else 1.
+
+    @property
+    def texts_per_sec(self):
+        return self.nr_texts / self.seconds if self.seconds else float('nan')
+
+    @property
+    def tokens_per_sec(self):
+        return self.real_tokens / self.seconds if self.seconds else float('nan')
+
+    def to_dict(self):
+        return {
+            'nr_texts': self.nr_texts,
+            'nr_batches': self.nr_batches,
+            'real_tokens': self.real_tokens,
+            'padded_tokens': self.padded_tokens,
+            'padding_efficiency': self.padding_efficiency,
+            'seconds': self.seconds,
+            'texts_per_sec': self.texts_per_sec,
+            'tokens_per_sec': self.tokens_per_sec,
+        }
+
+    def __repr__(self):
+        return (f'BatchStats(texts={self.nr_texts}, batches={self.nr_batches}, '
+                f'padding_efficiency={self.padding_efficiency:.2f}, texts_per_sec={self.texts_per_sec:.1f})')
+
+def token_lengths(text_list, tokenizer=None, max_length=None):
+    """
+    Returns the token length of each text
+
+    Args:
+        text_list (list): list of strings
+        tokenizer (object, optional): object with a tokenize(text) method (e.g. a HuggingFace tokenizer), defaults to None which counts whitespace separated words
+        max_length (int, optional): lengths are capped at this value, matching the model truncation, defaults to None
+    Returns:
+        numpy array of lengths
+
+    >>> token_lengths(['a b c', 'a', ''], max_length=2)
+    array([2, 1, 1])
+    """
+    if tokenizer is None:
+        lengths = [len(t.split()) for t in text_list]
+    else:
+        lengths = [len(tokenizer.tokenize(t)) for t in text_list]
+    lengths = np.maximum(np.array(lengths, dtype=np.int64), 1)
+    if max_length:
+        lengths = np.minimum(lengths, max_length)
+    return lengths
+
+def bucketed_batches(lengths, token_budget=4096, max_batch_size=None):
+    """
+    Groups texts into batches of similar length where each padded batch (batch size x longest text) stays within token_budget
+
+    Args:
+        lengths (list): token length of each text
+        token_budget (int, optional): maximal number of token slots per batch including padding, defaults to 4096
+        max_batch_size (int, optional): maximal number of texts per batch, defaults to None (no limit)
+    Returns:
+        list of index arrays into lengths, longest texts first
+
+    >>> bucketed_batches([1, 8, 2, 8, 1, 1], token_budget=16)
+    [array([1, 3]), array([2, 0, 4, 5])]
+    """
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches = []
+    start = 0
+    while start < len(order):
+        longest = lengths[order[start]]
+        size = max(1, int(token_budget // longest))
+        if max_batch_size:
+            size = min(size, max_batch_size)
+        batches.append(order[start:start+size])
+        start += size
+    return batches
+
+def bucketed_encode(text_list, model, token_budget=4096, max_batch_size=None, tokenizer=None, stats=None):
+    """
+    Encodes texts in length-sorted batches sized by a token budget instead of a fixed item count,
+    which avoids spending most of a batch on padding for corpora mixing short and long texts.
+    Embeddings are returned in the original order
+
+    Args:
+        text_list (list): list of strings to embed
+        model (object): model with an encode(text_list, batch_size, show_progress_bar, convert_to_numpy) method, e.g. SentenceTransformer
+        token_budget (int, optional): maximal number of token slots per batch including padding, defaults to 4096
+        max_batch_size (int, optional): maximal number of texts per batch, defaults to None (no limit)
+        tokenizer (object, optional): tokenizer used for lengths, defaults to None which uses model.tokenizer when available
+        stats (BatchStats, optional): statistics object to record padding and throughput into, defaults to None
+    Returns:
+        float32 matrix of embeddings, one row per string
+
+    >>> class ToyModel():
+    ...     def encode(self, text_list, **kwargs):
+    ...         return np.array([[len(t.split())] for t in text_list])
+    >>> stats = BatchStats()
+    >>> bucketed_encode(['a', 'a b c d', 'a b'], ToyModel(), token_budget=4, stats=stats)
+    array([[1.],
+           [4.],
+           [2.]], dtype=float32)
+    >>> stats.nr_batches, stats.padding_efficiency
+    (2, 0.875)
+    """
+    if len(text_list) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    tokenizer = getattr(model, 'tokenizer', None) if tokenizer is None else tokenizer
+    lengths = token_lengths(text_list, tokenizer=tokenizer, max_length=getattr(model, 'max_seq_length', None))
+    res = None
+    for batch in bucketed_batches(lengths, token_budget=token_budget, max_batch_size=max_batch_size):
+        t0 = time.perf_counter()
+        embeddings = np.asarray(model.encode([text_list[i] for i in batch], batch_size=len(batch),
+                                    show_progress_bar=False, convert_to_numpy=True), dtype=np.float32)
+        if stats is not None:
+            stats.add(lengths[batch], time.perf_counter() - t0)
+        if res is None:
+            res = np.empty((len(text_list), embeddings.shape[1]), dtype=np.float32)
+        res[batch] = embeddings
+    return res
@@ -0,0 +1,109 @@
+"""
+Figures converted once per (collection, map type, width, ...) into cached figure dicts of plain JSON types.
+Returning those from Dash callbacks skips plotly's figure validation and numpy conversion on every page view.
+Dash still encodes the dict into each response, which is cheap with orjson as plotly's JSON engine, see use_orjson
+"""
+from collections import OrderedDict
+import json
+import threading
+import plotly.io as pio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def use_orjson():
+    """
+    Makes orjson plotly's default JSON engine, which Dash also uses to encode callback responses. Changes plotly
+    globally, so it is left to the app's startup
+
+    Returns:
+        True if orjson is installed and now used
+    """
+    if orjson is None:
+        return False
+    pio.json.config.default_engine = 'orjson'
+    return True
+
+def strip_template(fig_dict):
+    """
+    Returns the figure without the template defaults of trace types it does not use, most of the template's size.
+    Only the dictionaries down to the template are copied, fig_dict itself is left as is
+
+    >>> fig = {'data': [{'type': 'treemap'}], 'layout': {'template': {'data': {'bar': [{}], 'treemap': [{}]}, 'layout': {}}}}
+    >>> strip_template(fig)['layout']['template']['data'], list(fig['layout']['template']['data'])
+    ({'treemap': [{}]}, ['bar', 'treemap'])
+    """
+    template = fig_dict.get('layout', {}).get('template')
+    if template and 'data' in template:
+        used = {trace.get('type', 'scatter') for trace in fig_dict.get('data', [])}
+        template = {**template, 'data': {k: v for k, v in template['data'].items() if k in used}}
+        fig_dict = {**fig_dict, 'layout': {**fig_dict['layout'], 'template': template}}
+    return fig_dict
+
+def figure_to_dict(fig):
+    """
+    Converts a plotly figure (or figure dictionary) to a plain dictionary of JSON types, without unused template parts
+    """
+    if isinstance(fig, dict):
+        return strip_template(fig)
+    if orjson is not None:
+        return strip_template(orjson.loads(pio.to_json(fig, engine='orjson')))
+    return strip_template(json.loads(pio.to_json(fig, engine='json')))
+
+class FigureCache():
+    """
+    Thread-safe least-recently-used cache of figure dicts. Keys are tuples starting with the collection name,
+    so a collection's figures can be dropped together
+    """
+    def __init__(self, max_size=64):
+        """
+        Args:
+            max_size (int, optional): maximal number of cached figures, defaults to 64
+
+        >>> cache = FigureCache(max_size=1)
+        >>> cache.get(('lex', 'treemap'), lambda: {'data': []}), cache.get(('lex', 'treemap'), lambda: None)
+        ({'data': []}, {'data': []})
+        >>> cache.hits, cache.misses
+        (1, 1)
+        >>> cache.drop('lex'), len(cache.figures)
+        (1, 0)
+        """
+        self.max_size = max_size
+        self.figures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        Returns the figure dict for key, calling build (returning a figure or figure dictionary) on a miss.
+        Keys should include whatever identifies the figure's data, e.g. the collection's content hash
+        """
+        with self._lock:
+            if key in self.figures:
+                self.hits += 1
+                self.figures.move_to_end(key)
+                return self.figures[key]
+            self.misses += 1
+        fig = figure_to_dict(build())
+        with self._lock:
+            self.figures[key] = fig
+            while len(self.figures) > self.max_size:
+                self.figures.popitem(last=False)
+        return fig
+
+    def drop(self, collection_name):
+        """
+        Drops the cached figures of a collection, e.g. once the collection is evicted, and returns how many were dropped
+        """
+        with self._lock:
+            keys = [key for key in self.figures if key[0] == collection_name]
+            for key in keys:
+                del self.figures[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.figures = OrderedDict()
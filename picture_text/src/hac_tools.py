@@ -1,19 +1,220 @@
 from picture_text.src.utils import flatten_list
-from scipy.cluster.hierarchy import to_tree
 #import matplotlib.pyplot as plt
 from scipy.cluster import hierarchy
+import heapq
 import numpy as np
 
+class HACTree():
+    """
+    Compact array representation of a HAC linkage table. Node ids follow scipy: leaves are 0..n-1 and
+    row i of the linkage table is node n+i. Leaves are stored in a precomputed order in which every
+    node's members form one contiguous slice, so member lookup and sizes need no tree walk
+    """
+    def __init__(self, linkage_table):
+        """
+        Builds the arrays from a linkage table
+
+        Args:
+            linkage_table (list): Linkage table produced as an output of a HAC algorithm (fastcluster or scipy)
+
+        >>> import fastcluster
+        >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
+        >>> tree = HACTree(fastcluster.single(X))
+        >>> tree.n_leaves, tree.root
+        (7, 12)
+        >>> tree.members(9), tree.size(9)
+        ([4, 5, 6], 3)
+        >>> tree.children(11)
+        (9, 10)
+        >>> tree.subtree_nodes(10)
+        [2, 3, 10]
+        >>> tree.leaf_order
+        array([0, 1, 4, 5, 6, 2, 3])
+        """
+        linkage_table = np.asarray(linkage_table, dtype=np.float64)
+        n = len(linkage_table) + 1
+        nr_nodes = 2 * n - 1
+        self.n_leaves = n
+        self.root = nr_nodes - 1
+        self.left = np.full(nr_nodes, -1, dtype=np.int64)
+        self.right = np.full(nr_nodes, -1, dtype=np.int64)
+        self.dist = np.zeros(nr_nodes, dtype=np.float64)
+        self.count = np.ones(nr_nodes, dtype=np.int64)
+        self.left[n:] = linkage_table[:,0]
+        self.right[n:] = linkage_table[:,1]
+        self.dist[n:] = linkage_table[:,2]
+        self.count[n:] = linkage_table[:,3]
+
+        # Parents always have larger ids than their children, so one top-down pass over the
+        # rows in reverse assigns each node the start of its slice in the leaf and node orders
+        left, right, count = self.left.tolist(), self.right.tolist(), self.count.tolist()
+        leaf_start = [0] * nr_nodes
+        node_start = [0] * nr_nodes
+        for node in range(nr_nodes - 1, n - 1, -1):
+            l, r = left[node], right[node]
+            leaf_start[l] = leaf_start[node]
+            leaf_start[r] = leaf_start[node] + count[l]
+            node_start[l] = node_start[node] + 1
+            node_start[r] = node_start[node] + 2 * count[l]
+        self.leaf_start = np.array(leaf_start, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.leaf_order = np.empty(n, dtype=np.int64)
+        self.leaf_order[self.leaf_start[:n]] = np.arange(n)
+        self.node_order = np.empty(nr_nodes, dtype=np.int64)
+        self.node_order[self.node_start] = np.arange(nr_nodes)
+
+    # Arrays fully describing a tree, see from_arrays
+    ARRAYS = ['left', 'right', 'dist', 'count', 'leaf_order', 'leaf_start', 'node_order', 'node_start']
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuilds a tree from the arrays named in HACTree.ARRAYS (e.g. memory-mapped from disk) without recomputing the orders
+
+        >>> import fastcluster
+        >>> tree = HACTree(fastcluster.single([[x] for x in [1001,1000,1,10,99,100,101]]))
+        >>> HACTree.from_arrays({a: getattr(tree, a) for a in HACTree.ARRAYS}).members(9)
+        [4, 5, 6]
+        """
+        tree = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree.n_leaves = len(tree.leaf_order)
+        tree.root = len(tree.count) - 1
+        return tree
+
+    def __len__(self):
+        return len(self.count)
+
+    def is_leaf(self, node):
+        return node < self.n_leaves
+
+    def size(self, node):
+        return int(self.count[node])
+
+    def children(self, node):
+        return int(self.left[node]), int(self.right[node])
+
+    def member_slice(self, node):
+        """
+        Returns the slice of leaf_order holding the members of node
+        """
+        start = int(self.leaf_start[node])
+        return slice(start, start + int(self.count[node]))
+
+    def members(self, node):
+        """
+        Returns the sorted list of original datapoints belonging to node
+        """
+        return np.sort(self.leaf_order[self.member_slice(node)]).tolist()
+
+    def subtree_nodes(self, node):
+        """
+        Returns the sorted list of all node ids (datapoints and clusters) in the subtree of node
+        """
+        start = int(self.node_start[node])
+        return np.sort(self.node_order[start:start + 2 * int(self.count[node]) - 1]).tolist()
+
+    def row(self, node):
+        """
+        Returns node in the legacy table form [id, left id, right id, distance, size], with '' as children of datapoints
+        """
+        if self.is_leaf(node):
+            return [node, '', '', 0, 1]
+        return [node, int(self.left[node]), int(self.right[node]), float(self.dist[node]), int(self.count[node])]
+
+    def top_nodes(self, node, nr_nodes):
+        """
+        Returns the nr_nodes clusters with the largest ids in the subtree of node, sorted by id.
+        Every parent has a larger id than its children, so these are found by expanding the subtree
+        from the top in O(nr_nodes log nr_nodes)
+
+        Args:
+            node (int): root of the subtree
+            nr_nodes (int): number of clusters to return, 0 or less returns all clusters of the subtree
+        Returns:
+            list of cluster ids
+
+        >>> import fastcluster
+        >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
+        >>> tree = HACTree(fastcluster.single(X))
+        >>> tree.top_nodes(12, 3), tree.top_nodes(9, 5), tree.top_nodes(3, 2)
+        ([10, 11, 12], [8, 9], [])
+        """
+        if nr_nodes <= 0:
+            nr_nodes = self.size(node) - 1
+        res = []
+        heap = [] if self.is_leaf(node) else [-node]
+        while heap and len(res) < nr_nodes:
+            top = -heapq.heappop(heap)
+            res.append(top)
+            for child in self.children(top):
+                if not self.is_leaf(child):
+                    heapq.heappush(heap, -child)
+        res.sort()
+        return res
+
+class HACSubtree():
+    """
+    Lightweight view of the subtree under one node of a shared HACTree, used instead of copying
+    the subtree into its own table
+    """
+    __slots__ = ('tree', 'root')
+
+    def __init__(self, tree, root):
+        """
+        Args:
+            tree (HACTree): tree the subtree belongs to
+            root (int): id of the root node of the subtree
+
+        >>> import fastcluster
+        >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
+        >>> sub = HACSubtree(HACTree(fastcluster.single(X)), 10)
+        >>> sub
+        HACSubtree(root=10, size=2)
+        >>> sub.to_dict()
+        {2: [2, '', '', 0, 1], 3: [3, '', '', 0, 1], 10: [10, 2, 3, 9.0, 2]}
+        """
+        self.tree = tree
+        self.root = root
+
+    def __len__(self):
+        return self.tree.size(self.root)
+
+    def members(self):
+        """
+        Returns the sorted list of original datapoints in the subtree, read from the tree's leaf order on demand
+        """
+        return self.tree.members(self.root)
+
+    def to_dict(self):
+        """
+        Returns the subtree in the legacy table form {id: [id, left id, right id, distance, size]}
+        """
+        return {m: self.tree.row(m) for m in self.tree.subtree_nodes(self.root)}
+
+    def __eq__(self, other):
+        return isinstance(other, HACSubtree) and self.tree is other.tree and self.root == other.root
+
+    def __hash__(self):
+        return hash((id(self.tree), self.root))
+
+    def __repr__(self):
+        return f'HACSubtree(root={self.root}, size={len(self)})'
+
 class HAC():
     def __init__(self, linkage_table, parent=None):
         """
         Instantiates a class, starting with a fastcluster or scipy HAC linkage table and helping the move to a treemap
         Alternatively this can also receive a ready linkage table or a subset thereof for the cases where only a part of the tree is being analysed
+        Linkage tables are held as a HACTree, the dictionary form in tbl is only built when accessed
 
         Args:
-            linkage_table (list or dict): 
+            linkage_table (list, HACTree, HACSubtree or dict): 
                 Linkage table produced as an output of a HAC algorithm (fastcluster or scipy) 
                 OR
+                a HACTree built from one, or a HACSubtree view of a part of it
+                OR
                 a dictionary table subset thereof
             parent (int or string, optional): Parent ID value to be used as parent of this dataset
 
@@ -35,14 +236,37 @@ class HAC():
             self.parent = -1
         else:
             self.parent = parent
-        if not isinstance(linkage_table, dict):
+        if isinstance(linkage_table, HACSubtree):
+            self.linkage_table = None
+            self.tree = linkage_table.tree
+            self.root = linkage_table.root
+            self._tbl = None
+            self._tbl_clusters = None
+        elif not isinstance(linkage_table, dict):
             self.linkage_table = linkage_table
-            self.rootnode, self.nodelist = to_tree(self.linkage_table, rd=True)
-            self.tbl = {i: [i, left_clust(nd), right_clust(nd), nd.dist, nd.count] for (i, nd) in enumerate(self.nodelist)}
+            self.tree = linkage_table if isinstance(linkage_table, HACTree) else HACTree(linkage_table)
+            self.root = self.tree.root
+            self._tbl = None
+            self._tbl_clusters = None
         else:
-            self.tbl = linkage_table
-        self.tbl_clusters = list(self.tbl.keys())
-        self.tbl_clusters.sort()
+            self.tree = None
+            self._tbl = linkage_table
+            self._tbl_clusters = sorted(linkage_table.keys())
+
+    @property
+    def tbl(self):
+        """
+        Legacy dictionary form of the tree {id: [id, left id, right id, distance, size]}, built on first access
+        """
+        if self._tbl is None:
+            self._tbl = {i: self.tree.row(i) for i in self.tbl_clusters}
+        return self._tbl
+
+    @property
+    def tbl_clusters(self):
+        if self._tbl_clusters is None:
+            self._tbl_clusters = self.tree.subtree_nodes(self.root)
+        return self._tbl_clusters
 
     def dendrogram(self, **kwargs):
         """
@@ -81,6 +305,12 @@ class HAC():
         >>> t
         {0: [0, '', '', 0, 1], 1: [1, '', '', 0, 1], 2: [2, '', '', 0, 1], 3: [3, '', '', 0, 1], 4: [4, '', '', 0, 1], 5: [5, '', '', 0, 1], 6: [6, '', '', 0, 1], 7: [7, 0, 1, 1.0, 2], 8: [8, 5, 6, 1.0, 2], 9: [9, 4, 8, 1.0, 3], 10: [10, 2, 3, 9.0, 2], 11: [11, 9, 10, 89.0, 5], 12: [12, 7, 11, 899.0, 7]}
         """
+        if self.tree is not None:
+            members = self.tree.members(cluster_id)
+            clusters = self.tree.top_nodes(cluster_id, 0)
+            table = {m: self.tree.row(m) for m in self.tree.subtree_nodes(cluster_id)}
+            return members, clusters, table
+
         memb=[]
         get_idx=new_memb=[cluster_id]
 
@@ -111,6 +341,14 @@ class HAC():
         >>> total_size
         7
         """
+        if self.tree is not None:
+            clust_id = self.tree.top_nodes(self.root, nr_clusters)
+            in_clust = set(clust_id)
+            child_id = [c for c in flatten_list([self.tree.children(t) for t in clust_id]) if c not in in_clust]
+            child_size = [self.tree.size(c) for c in child_id]
+            total_size = sum(child_size)
+            return child_id, child_size, total_size
+
         clust_id=self.tbl_clusters[-nr_clusters:]
         clust_id=[c for c in clust_id if self.tbl[c][1]!='']
         top_n=[self.tbl[c] for c in clust_id if self.tbl[c][1]!='']
@@ -139,14 +377,20 @@ class HAC():
             - If again 2 of the 5 are under 10%, this would mean increasing number of splits to 7, however, the max is 6 so we end up with 6
 
         Returns:
-            res (list): List of dictionaries containing details (ids, parent, members, table, size) of all relevant clusters found
+            res (list): List of dictionaries containing details (ids, parent, members, table, size) of all relevant clusters found,
+                for trees the table is a HACSubtree view rather than a copy and members are not stored,
+                cluster_table.members() reads them from the tree on demand
 
         >>> X=[[x] for x in [1001,1000,1,10,99,100,101]]
         >>> z=fastcluster.single(X)
         >>> hac = HAC(z)
         >>> res = hac.top_n_good_clusters(3)
         >>> res
-        {9: {'cluster_id': 9, 'cluster_parent': -1, 'cluster_members': [4, 5, 6], 'cluster_table': {4: [4, '', '', 0, 1], 5: [5, '', '', 0, 1], 6: [6, '', '', 0, 1], 8: [8, 5, 6, 1.0, 2], 9: [9, 4, 8, 1.0, 3]}, 'cluster_size': 3}, 10: {'cluster_id': 10, 'cluster_parent': -1, 'cluster_members': [2, 3], 'cluster_table': {2: [2, '', '', 0, 1], 3: [3, '', '', 0, 1], 10: [10, 2, 3, 9.0, 2]}, 'cluster_size': 2}, 7: {'cluster_id': 7, 'cluster_parent': -1, 'cluster_members': [0, 1], 'cluster_table': {0: [0, '', '', 0, 1], 1: [1, '', '', 0, 1], 7: [7, 0, 1, 1.0, 2]}, 'cluster_size': 2}}
+        {9: {'cluster_id': 9, 'cluster_parent': -1, 'cluster_table': HACSubtree(root=9, size=3), 'cluster_size': 3}, 10: {'cluster_id': 10, 'cluster_parent': -1, 'cluster_table': HACSubtree(root=10, size=2), 'cluster_size': 2}, 7: {'cluster_id': 7, 'cluster_parent': -1, 'cluster_table': HACSubtree(root=7, size=2), 'cluster_size': 2}}
+        >>> res[9]['cluster_table'].members()
+        [4, 5, 6]
+        >>> res[9]['cluster_table'].to_dict()
+        {4: [4, '', '', 0, 1], 5: [5, '', '', 0, 1], 6: [6, '', '', 0, 1], 8: [8, 5, 6, 1.0, 2], 9: [9, 4, 8, 1.0, 3]}
         """
         
         nr_clusters = nr_clusters - 1
@@ -163,6 +407,11 @@ class HAC():
         
         res = {}
         for c in clust_id:
+            if self.tree is not None:
+                # Storing every node's members would take O(N x depth) over the whole treemap
+                t = HACSubtree(self.tree, c)
+                res[c] = {'cluster_id': c, 'cluster_parent': self.parent, 'cluster_table': t, 'cluster_size': len(t)}
+                continue
             m,_,t = self.get_members(c)
             res[c]={
                 'cluster_id': c,
@@ -0,0 +1,158 @@
+"""
+Incremental insertion of new documents into an existing HAC linkage table, avoiding a full HAC
+rebuild when a few documents are added to a large map. Each new document descends greedily from
+the root towards the closer child centroid and is attached as a sibling of the first node it does
+not fit into. Counts and centroid sums are updated along the path
+"""
+import heapq
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from picture_text.src.hac_tools import HACTree
+
+class IncrementalLinkage():
+    """
+    Linkage table open for insertions. Nodes keep stable ids while inserting (original ids for the
+    initial tree, new ids appended after them), the scipy form is produced by linkage_table()
+    """
+    def __init__(self, linkage_table, embeddings, method='ward', metric='euclidean'):
+        """
+        Args:
+            linkage_table (array): scipy style linkage table of the documents in embeddings
+            embeddings (list or array): N x d embeddings, row i belongs to leaf i
+            method (string, optional): HAC method the table was built with, ward uses ward merge heights, defaults to 'ward'
+            metric (string, optional): distance metric the table was built with, defaults to 'euclidean'
+
+        >>> import fastcluster
+        >>> X = np.array([[1001.], [1000.], [1.], [10.], [99.], [100.], [101.]])
+        >>> inc = IncrementalLinkage(fastcluster.linkage(X, method='ward'), X)
+        >>> inc.insert([102.])
+        7
+        >>> inc.linkage_table()
+        array([[0.00000000e+00, 1.00000000e+00, 1.00000000e+00, 2.00000000e+00],
+               [6.00000000e+00, 7.00000000e+00, 1.00000000e+00, 2.00000000e+00],
+               [5.00000000e+00, 9.00000000e+00, 1.00000000e+00, 3.00000000e+00],
+               [4.00000000e+00, 1.00000000e+01, 1.73205081e+00, 4.00000000e+00],
+               [2.00000000e+00, 3.00000000e+00, 9.00000000e+00, 2.00000000e+00],
+               [1.10000000e+01, 1.20000000e+01, 1.46398770e+02, 6.00000000e+00],
+               [8.00000000e+00, 1.30000000e+01, 1.58601647e+03, 8.00000000e+00]])
+        """
+        self.tree = HACTree(linkage_table)
+        self.embeddings = np.asarray(embeddings, dtype=np.float64)
+        self.method = method
+        self.metric = metric
+        n = self.tree.n_leaves
+        self.n_docs = n
+        self.left = self.tree.left.tolist()
+        self.right = self.tree.right.tolist()
+        self.dist = self.tree.dist.tolist()
+        self.count = self.tree.count.tolist()
+        self.doc = list(range(n)) + [-1] * (n - 1)
+        self.parent = [-1] * len(self.left)
+        for node in range(n, len(self.left)):
+            self.parent[self.left[node]] = node
+            self.parent[self.right[node]] = node
+        self.root = self.tree.root
+        self.new_embeddings = []
+        # Centroid sums, computed on first use; every node whose members changed is on an insertion path and therefore cached
+        self.sums = {}
+
+    def _sum(self, node):
+        if node not in self.sums:
+            self.sums[node] = self.embeddings[self.tree.leaf_order[self.tree.member_slice(node)]].sum(axis=0)
+        return self.sums[node]
+
+    def _height(self, x, node):
+        """
+        Merge height of x with node: ward height for ward, otherwise the distance of x to the node centroid
+        """
+        count = self.count[node]
+        centroid = self._sum(node) / count
+        if self.method == 'ward':
+            return float(np.sqrt(2 * count / (count + 1)) * np.linalg.norm(x - centroid))
+        return float(cdist([x], [centroid], metric=self.metric)[0, 0])
+
+    def _add_node(self, left, right, dist, count, doc):
+        self.left.append(left)
+        self.right.append(right)
+        self.dist.append(dist)
+        self.count.append(count)
+        self.doc.append(doc)
+        self.parent.append(-1)
+        return len(self.left) - 1
+
+    def insert(self, x):
+        """
+        Inserts one document
+
+        Args:
+            x (list or array): embedding of the document
+        Returns:
+            document index of the new leaf
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self._sum(self.root)
+        node = self.root
+        # Descend while x fits below the node's merge height
+        while self.doc[node] < 0:
+            heights = [self._height(x, child) for child in (self.left[node], self.right[node])]
+            if min(heights) > self.dist[node]:
+                break
+            node = (self.left[node], self.right[node])[int(np.argmin(heights))]
+
+        up = self.parent[node]
+        height = max(self.dist[node], self._height(x, node))
+        if up >= 0:
+            height = min(height, self.dist[up])
+        doc = self.n_docs + len(self.new_embeddings)
+        self.new_embeddings.append(x)
+        leaf = self._add_node(-1, -1, 0., 1, doc)
+        self.sums[leaf] = x
+        merged = self._add_node(node, leaf, height, self.count[node] + 1, -1)
+        self.sums[merged] = self._sum(node) + x
+        self.parent[node] = merged
+        self.parent[leaf] = merged
+        self.parent[merged] = up
+        if up < 0:
+            self.root = merged
+        else:
+            if self.left[up] == node:
+                self.left[up] = merged
+            else:
+                self.right[up] = merged
+            while up >= 0:
+                self.count[up] += 1
+                self.sums[up] = self.sums[up] + x
+                up = self.parent[up]
+        return doc
+
+    def linkage_table(self):
+        """
+        Returns the scipy style linkage table over all documents, leaves are numbered by document index.
+        Clusters are numbered by merge height, always after their children
+        """
+        n = self.n_docs + len(self.new_embeddings)
+        ids = np.full(len(self.left), -1, dtype=np.int64)
+        waiting = [0] * len(self.left)
+        heap = []
+        for node in range(len(self.left)):
+            if self.doc[node] >= 0:
+                ids[node] = self.doc[node]
+            elif self.parent[node] >= 0 or node == self.root:
+                waiting[node] = sum(self.doc[child] < 0 for child in (self.left[node], self.right[node]))
+                if waiting[node] == 0:
+                    heapq.heappush(heap, (self.dist[node], node))
+        res = np.zeros((n - 1, 4))
+        row = 0
+        while heap:
+            _, node = heapq.heappop(heap)
+            ids[node] = n + row
+            res[row] = [ids[self.left[node]], ids[self.right[node]], self.dist[node], self.count[node]]
+            row += 1
+            up = self.parent[node]
+            if up >= 0:
+                waiting[up] -= 1
+                if waiting[up] == 0:
+                    heapq.heappush(heap, (self.dist[up], up))
+        assert(row == n - 1)
+        return res
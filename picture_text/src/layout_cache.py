@@ -0,0 +1,130 @@
+"""
+Memoization of treemap layouts for one linkage table. Split decisions are keyed by node and split
+parameters and summaries by summarizer and node, so re-running make_picture with new layer settings
+only computes the nodes that were not seen before
+"""
+from collections import OrderedDict
+import numpy as np
+
+from picture_text.src.hac_tools import HAC
+from picture_text.src.summarizers import run_summarizer
+
+class LayoutCache():
+    """
+    Per node split and summary cache, valid for the linkage table it was cleared with (source).
+    Splits and summaries are each kept up to max_entries, least recently used ones are dropped first
+    """
+    def __init__(self, max_entries=100000):
+        """
+        Initialize an empty cache
+
+        Args:
+            max_entries (int, optional): maximal number of cached splits and, separately, of cached summaries, defaults to 100000
+
+        >>> import fastcluster
+        >>> from picture_text.src.hac_tools import HACTree
+        >>> tree = HACTree(fastcluster.linkage([[x] for x in [1001,1000,1,10,99,100,101]], method='ward'))
+        >>> cache = LayoutCache()
+        >>> sorted(cache.split(tree, 'Full', 3, 0.1, 1))
+        [7, 9, 10]
+        >>> sorted(cache.split(tree, 'Full', 3, 0.1, 1))
+        [7, 9, 10]
+        >>> cache.hits, cache.misses
+        (1, 1)
+        >>> cache = LayoutCache(max_entries=2)
+        >>> for min_size in [0.1, 0.2, 0.3]:
+        ...     _ = cache.split(tree, 'Full', 3, min_size, 1)
+        >>> [key[3] for key in cache.splits]
+        [0.2, 0.3]
+        """
+        self.max_entries = max_entries
+        self.source = None
+        self.splits = OrderedDict()
+        self.summaries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self, source=None):
+        """
+        Drops all cached splits and summaries
+
+        Args:
+            source (object, optional): linkage table the cache is valid for from now on, defaults to None
+        """
+        self.source = source
+        self.splits = OrderedDict()
+        self.summaries = OrderedDict()
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def split(self, linkage_table, parent, nr_splits, min_size, max_extension):
+        """
+        Returns HAC(linkage_table, parent).top_n_good_clusters(nr_splits, min_size, max_extension), computed once per node and parameters
+
+        Args:
+            linkage_table (HACTree or HACSubtree): node to split
+            parent (int or string): parent id given to the clusters found
+            nr_splits (int): number of clusters to seek
+            min_size (float): minimal size of a cluster as a % of the node size
+            max_extension (float): percent extension to nr_splits if min_size is not met
+        Returns:
+            dictionary of clusters as returned by HAC.top_n_good_clusters
+        """
+        key = (linkage_table.root, parent, nr_splits, min_size, max_extension)
+        if key in self.splits:
+            self.hits += 1
+            self.splits.move_to_end(key)
+            return self.splits[key]
+        self.misses += 1
+        clusters = HAC(linkage_table, parent=parent).top_n_good_clusters(nr_splits, min_size=min_size, max_extension=max_extension)
+        self._put(self.splits, key, clusters)
+        return clusters
+
+    def summarize(self, key, summarizer, nodes):
+        """
+        Runs summarizer on the nodes without a cached summary for key. Nodes scored nan (e.g. timed out) are not cached
+
+        Args:
+            key (object): identifies the summarizer, e.g. the summarizer function itself
+            summarizer (object): batched or per node summarizer
+            nodes (TreeNodes): nodes to summarize
+        Returns:
+            labels (list): summary per node
+            scores (array): score per node
+
+        >>> from picture_text.src.summarizers import TreeNodes
+        >>> calls = []
+        >>> def summarizer(t, e):
+        ...     calls.append(len(t))
+        ...     return str(t[0]), len(t)
+        >>> cache = LayoutCache()
+        >>> nodes = TreeNodes(np.zeros((3, 1)), ['a', 'b', 'c'], np.arange(3), [0, 0], [3, 2], [4, 3])
+        >>> cache.summarize(summarizer, summarizer, nodes)
+        (['a', 'a'], array([3., 2.]))
+        >>> cache.summarize(summarizer, summarizer, TreeNodes(nodes.embeddings, nodes.txt, nodes.leaf_order, [0, 2], [2, 3], [3, 2]))
+        (['a', 'c'], array([2., 1.]))
+        >>> calls
+        [3, 2, 1]
+        """
+        labels = [None] * len(nodes)
+        scores = np.empty(len(nodes), dtype=np.float64)
+        missing = []
+        for i, node in enumerate(nodes.node_ids):
+            cached = self.summaries.get((key, int(node)))
+            if cached is None:
+                missing.append(i)
+            else:
+                self.summaries.move_to_end((key, int(node)))
+                labels[i], scores[i] = cached
+        self.hits += len(nodes) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            new_labels, new_scores = run_summarizer(summarizer, nodes.subset(np.array(missing)))
+            for i, label, score in zip(missing, new_labels, new_scores):
+                labels[i], scores[i] = label, score
+                if not np.isnan(score):
+                    self._put(self.summaries, (key, int(nodes.node_ids[i])), (label, score))
+        return labels, scores
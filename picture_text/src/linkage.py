@@ -0,0 +1,193 @@
+"""
+Linkage engine selection for HAC. fastcluster.linkage materialises an O(N^2) condensed
+distance matrix, fastcluster.linkage_vector works on the observation vectors directly
+with O(N*D) memory but only supports some method/metric combinations
+"""
+import logging
+import os
+import numpy as np
+import fastcluster
+
+logger = logging.getLogger(__name__)
+
+# Methods supported by fastcluster.linkage_vector and the metrics they accept, None meaning any
+VECTOR_METHODS = {
+    'single': None,
+    'ward': ['euclidean'],
+    'centroid': ['euclidean'],
+    'median': ['euclidean'],
+}
+
+class LinkageMemoryError(MemoryError):
+    """
+    Raised when the linkage is expected to exceed the memory budget
+    """
+    pass
+
+def supports_vector(method, metric):
+    """
+    Checks whether fastcluster.linkage_vector can be used for a method and metric
+
+    >>> supports_vector('ward', 'euclidean')
+    True
+    >>> supports_vector('ward', 'cosine')
+    False
+    >>> supports_vector('average', 'euclidean')
+    False
+    """
+    if method not in VECTOR_METHODS:
+        return False
+    return VECTOR_METHODS[method] is None or metric in VECTOR_METHODS[method]
+
+def estimate_linkage_memory(n, dim, engine):
+    """
+    Estimates peak memory in bytes of a linkage run on n observations of dimension dim
+
+    Args:
+        n (int): number of observations
+        dim (int): dimension of each observation
+        engine (string): 'vector' for fastcluster.linkage_vector or 'matrix' for fastcluster.linkage
+    Returns:
+        estimated bytes
+
+    >>> estimate_linkage_memory(60000, 768, 'matrix') // 2**30
+    13
+    >>> estimate_linkage_memory(60000, 768, 'vector') // 2**20
+    708
+    """
+    # float64 copy of the observations, the (n-1) x 4 output and O(n) working arrays
+    base = 8 * n * dim + 32 * n + 64 * n
+    if engine == 'vector':
+        # centroid/median keep a second copy of the observations for updated centroids
+        return base + 8 * n * dim
+    return base + 8 * n * (n - 1) // 2
+
+def available_memory():
+    """
+    Returns the physical memory currently available in bytes, None if it cannot be determined
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def parse_memory(memory):
+    """
+    Converts a memory size to bytes
+
+    Args:
+        memory (int or string): bytes, or a string with unit such as '512MB' or '4GB'
+    Returns:
+        bytes (int)
+
+    >>> parse_memory('4GB')
+    4294967296
+    >>> parse_memory('1.5 kb')
+    1536
+    >>> parse_memory(100)
+    100
+    """
+    if memory is None or isinstance(memory, (int, float)):
+        return memory
+    units = {'TB': 2**40, 'GB': 2**30, 'MB': 2**20, 'KB': 2**10, 'B': 1}
+    value = memory.strip().upper()
+    for unit, size in units.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * size)
+    return int(float(value))
+
+def format_memory(nr_bytes):
+    """
+    Formats bytes for messages
+
+    >>> format_memory(3 * 2**20), format_memory(40 * 2**30)
+    ('3.0MB', '40.0GB')
+    """
+    if nr_bytes >= 2**30:
+        return f'{nr_bytes/2**30:.1f}GB'
+    return f'{nr_bytes/2**20:.1f}MB'
+
+def select_linkage_engine(n, dim, method, metric, engine='auto', memory_budget=None):
+    """
+    Picks the linkage engine for a run and checks its estimated peak memory against the budget.
+    'auto' keeps the faster matrix engine while it needs at most half the budget and otherwise switches
+    to the memory-saving vector engine when the method and metric allow it.
+    An explicit 'matrix' request falls back to the vector engine if only that one fits the budget
+
+    Args:
+        n (int): number of observations
+        dim (int): dimension of each observation
+        method (string): HAC method
+        metric (string): distance metric
+        engine (string, optional): 'auto', 'vector' or 'matrix', defaults to 'auto'
+        memory_budget (int or string, optional): maximal bytes the linkage may use, defaults to None which uses the available physical memory
+    Returns:
+        engine (string): 'vector' or 'matrix'
+        estimate (int): estimated peak memory in bytes
+
+    >>> select_linkage_engine(10000, 384, 'ward', 'euclidean', memory_budget='4GB')
+    ('matrix', 431640000)
+    >>> select_linkage_engine(100000, 384, 'ward', 'euclidean', memory_budget='4GB')
+    ('vector', 624000000)
+    >>> select_linkage_engine(100000, 384, 'average', 'cosine', memory_budget='4GB')
+    Traceback (most recent call last):
+    ...
+    picture_text.src.linkage.LinkageMemoryError: HAC with average method and cosine distances on 100000 documents needs about 37.5GB, more than the 4.0GB budget. Use method single/ward/centroid/median (ward/centroid/median with euclidean distances) for the memory-saving vector engine, a larger memory_budget or the approximate mode (approx_clusters)
+    """
+    if engine not in ['auto', 'vector', 'matrix']:
+        raise ValueError(f"Unknown linkage engine {engine}, use 'auto', 'vector' or 'matrix'")
+    vector_ok = supports_vector(method, metric)
+    if engine == 'vector' and not vector_ok:
+        raise ValueError(f'The vector linkage engine does not support {method} method with {metric} distances')
+    budget = parse_memory(memory_budget) if memory_budget is not None else available_memory()
+
+    if engine == 'auto':
+        fits = budget is None or estimate_linkage_memory(n, dim, 'matrix') <= budget / 2
+        engine = 'vector' if vector_ok and not fits else 'matrix'
+    estimate = estimate_linkage_memory(n, dim, engine)
+    if budget is not None and estimate > budget:
+        if engine == 'matrix' and vector_ok and estimate_linkage_memory(n, dim, 'vector') <= budget:
+            logger.warning('Linkage matrix engine needs about %s, falling back to vector engine', format_memory(estimate))
+            engine = 'vector'
+            estimate = estimate_linkage_memory(n, dim, engine)
+        else:
+            raise LinkageMemoryError(f'HAC with {method} method and {metric} distances on {n} documents needs about '
+                f'{format_memory(estimate)}, more than the {format_memory(budget)} budget. '
+                'Use method single/ward/centroid/median (ward/centroid/median with euclidean distances) '
+                'for the memory-saving vector engine, a larger memory_budget or the approximate mode (approx_clusters)')
+    return engine, estimate
+
+def linkage(X, method='ward', metric='euclidean', engine='auto', memory_budget=None):
+    """
+    Runs HAC with the engine chosen by select_linkage_engine
+
+    Args:
+        X (list or array): observation vectors, one per row
+        method (string, optional): HAC method used by fastcluster, defaults to 'ward'
+        metric (string, optional): Distance metric used by fastcluster, defaults to 'euclidean'
+        engine (string, optional): 'auto', 'vector' or 'matrix', defaults to 'auto'
+        memory_budget (int or string, optional): maximal bytes the linkage may use, defaults to None which uses the available physical memory
+    Returns:
+        linkage_table (array): scipy style linkage table
+        engine (string): engine used
+
+    >>> Z, engine = linkage([[x] for x in [1001,1000,1,10,99,100,101]], engine='vector')
+    >>> engine
+    'vector'
+    >>> Z[:, 3]
+    array([2., 2., 3., 2., 5., 7.])
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    engine, _ = select_linkage_engine(X.shape[0], X.shape[1], method, metric, engine=engine, memory_budget=memory_budget)
+    if engine == 'vector':
+        return fastcluster.linkage_vector(X, method=method, metric=metric), engine
+    return fastcluster.linkage(X, method=method, metric=metric), engine
@@ -0,0 +1,209 @@
+"""
+Background email delivery for the feedback form. Messages are written to an outbox directory and sent by a
+background thread over one reused SMTP connection, with retries and exponential backoff. Callers return as soon
+as the message is queued, and messages still in the outbox after a restart are sent by the next process
+"""
+import json
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Mailer():
+    """
+    Bounded queue of outgoing messages persisted in an outbox directory and delivered by a background thread
+    """
+    def __init__(self, host, port, username, password, outbox='./outbox', max_queue=100, max_retries=5,
+                 backoff=1.0, max_backoff=60.0, idle_timeout=60.0, smtp_factory=None):
+        """
+        Args:
+            host (string): SMTP server
+            port (int): SMTP port, SSL is used
+            username (string): SMTP login, also the default recipient
+            password (string): SMTP password
+            outbox (string, optional): directory persisting queued messages, defaults to './outbox'
+            max_queue (int, optional): maximal number of queued messages, further messages are refused, defaults to 100
+            max_retries (int, optional): attempts per message before it is moved to outbox/failed, defaults to 5
+            backoff (float, optional): seconds to wait after the first failed attempt, doubled after each further one, defaults to 1
+            max_backoff (float, optional): maximal seconds between attempts, defaults to 60
+            idle_timeout (float, optional): seconds without messages after which the connection is closed, defaults to 60
+            smtp_factory (object, optional): function returning a logged in SMTP connection, defaults to None which uses SMTP_SSL with host, port and login
+
+        >>> import tempfile
+        >>> class FakeSMTP():
+        ...     sent = []
+        ...     def sendmail(self, from_addr, to_addrs, msg):
+        ...         self.sent.append((from_addr, to_addrs, msg))
+        ...     def quit(self):
+        ...         pass
+        >>> mailer = Mailer('localhost', 0, 'me@example.com', '', outbox=tempfile.mkdtemp(), smtp_factory=FakeSMTP)
+        >>> mailer.send('you@example.com', 'Subject: hi')
+        True
+        >>> mailer.flush(timeout=5)
+        True
+        >>> FakeSMTP.sent, mailer.stats()['sent']
+        ([('you@example.com', 'me@example.com', 'Subject: hi')], 1)
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.outbox = outbox
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self.smtp_factory = smtp_factory or self._connect
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.refused = 0
+        self._smtp = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        for d in ['', 'sending', 'failed']:
+            os.makedirs(os.path.join(outbox, d), exist_ok=True)
+
+    def _connect(self):
+        smtp = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context(), timeout=30)
+        smtp.login(self.username, self.password)
+        return smtp
+
+    def _start(self):
+        """
+        Starts the sender thread in this process, e.g. after a fork, and queues messages left in the outbox
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._recover()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _recover(self):
+        # Messages claimed by processes that died are put back into the outbox
+        sending = os.path.join(self.outbox, 'sending')
+        for name in os.listdir(sending):
+            pid = int(name.split('-', 1)[0])
+            if pid != os.getpid() and not _pid_alive(pid):
+                os.replace(os.path.join(sending, name), os.path.join(self.outbox, name.split('-', 1)[1]))
+        for name in sorted(os.listdir(self.outbox)):
+            if name.endswith('.json'):
+                try:
+                    self.queue.put_nowait(name)
+                except queue.Full:
+                    break
+
+    def send(self, from_addr, msg, to_addrs=None):
+        """
+        Queues a message, returns at once
+
+        Args:
+            from_addr (string): sender address
+            msg (string): message including headers
+            to_addrs (string or list, optional): recipients, defaults to None which sends to username
+        Returns:
+            True if the message was queued, False if the queue is full
+        """
+        self._start()
+        if self.queue.full():
+            self.refused += 1
+            return False
+        name = f'{time.time_ns()}-{uuid.uuid4().hex}.json'
+        path = os.path.join(self.outbox, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'from_addr': from_addr, 'to_addrs': to_addrs or self.username, 'msg': msg}, f)
+        os.replace(path + '.tmp', path)
+        try:
+            self.queue.put_nowait(name)
+        except queue.Full:
+            # Stays in the outbox and is sent after the next restart
+            self.refused += 1
+            return False
+        return True
+
+    def _close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _deliver(self, message):
+        for attempt in range(self.max_retries):
+            try:
+                if self._smtp is None:
+                    self._smtp = self.smtp_factory()
+                self._smtp.sendmail(message['from_addr'], message['to_addrs'], message['msg'])
+                return True
+            except Exception as e:
+                logger.warning('Sending email failed (attempt %d of %d): %s', attempt + 1, self.max_retries, e)
+                self._close()
+                if attempt + 1 < self.max_retries:
+                    self.retries += 1
+                    time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+        return False
+
+    def _run(self):
+        while True:
+            try:
+                name = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._close()
+                continue
+            try:
+                # Claim the message so other processes sharing the outbox skip it
+                claimed = os.path.join(self.outbox, 'sending', f'{os.getpid()}-{name}')
+                try:
+                    os.replace(os.path.join(self.outbox, name), claimed)
+                except FileNotFoundError:
+                    continue
+                with open(claimed) as f:
+                    message = json.load(f)
+                if self._deliver(message):
+                    self.sent += 1
+                    os.remove(claimed)
+                else:
+                    self.failed += 1
+                    os.replace(claimed, os.path.join(self.outbox, 'failed', name))
+            except Exception as e:
+                logger.exception('Email outbox error: %s', e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued messages were handled, returns False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        """
+        Returns sent, failed, retried and refused message counts and the queue length
+        """
+        return {'sent': self.sent, 'failed': self.failed, 'retries': self.retries, 'refused': self.refused,
+                'queued': self.queue.qsize()}
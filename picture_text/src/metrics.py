@@ -0,0 +1,136 @@
+"""
+Stage timings and counters of a PictureText pipeline. Each stage records high-resolution wall time and, when
+memory tracing is on, the tracemalloc peak above the memory allocated when the stage started. Hooks receive every
+stage and counter update, e.g. to forward them to a metrics system
+"""
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+class Metrics():
+    """
+    Per stage timings, optional peak memory and counters, kept as totals over all runs of a stage plus the last run
+    """
+    def __init__(self, trace_memory=False, hooks=None):
+        """
+        Args:
+            trace_memory (bool, optional): record the tracemalloc peak of each stage, slows allocation heavy stages down, defaults to False
+            hooks (list, optional): functions of the form hook(kind, name, value) called with kind 'stage' and the stage record
+                (calls, seconds, last_seconds, peak_bytes) or kind 'counter' and the increment, defaults to None
+
+        >>> events = []
+        >>> metrics = Metrics(trace_memory=True, hooks=[lambda kind, name, value: events.append((kind, name))])
+        >>> with metrics.stage('outer'):
+        ...     with metrics.stage('inner'):
+        ...         block = bytearray(10**6)
+        ...     del block
+        >>> metrics.count('nodes_built', 3)
+        >>> events
+        [('stage', 'inner'), ('stage', 'outer'), ('counter', 'nodes_built')]
+        >>> metrics.stages['outer']['calls'], metrics.stages['outer']['peak_bytes'] >= 10**6, metrics.counters['nodes_built']
+        (1, True, 3)
+        """
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks or [])
+        self.stages = {}
+        self.counters = Counter()
+        self._stack = []
+        self._started_tracing = False
+
+    def add_hook(self, hook):
+        """
+        Adds a function of the form hook(kind, name, value), see __init__
+        """
+        self.hooks.append(hook)
+
+    def _notify(self, kind, name, value):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value)
+            except Exception:
+                # A broken metrics backend should not break the pipeline
+                logger.exception('Metrics hook failed for %s %s', kind, name)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as stage name, stages can be nested
+
+        Yields:
+            dictionary filled with seconds and peak_bytes (None without memory tracing) of this run when the block exits
+        """
+        run = {'seconds': None, 'peak_bytes': None}
+        frame = {'start': None, 'peak': 0}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            # Resetting the peak for this stage would lose the enclosing stages' peak, so hand it to them first
+            for parent in self._stack:
+                parent['peak'] = max(parent['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start'] = current
+        self._stack.append(frame)
+        t0 = time.perf_counter()
+        try:
+            yield run
+        finally:
+            run['seconds'] = time.perf_counter() - t0
+            self._stack.pop()
+            if frame['start'] is not None and tracemalloc.is_tracing():
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                run['peak_bytes'] = max(peak - frame['start'], 0)
+                for parent in self._stack:
+                    parent['peak'] = max(parent['peak'], peak)
+                if not self._stack and self._started_tracing:
+                    tracemalloc.stop()
+                    self._started_tracing = False
+            self._record(name, run)
+
+    def _record(self, name, run):
+        record = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'last_seconds': None, 'peak_bytes': None})
+        record['calls'] += 1
+        record['seconds'] += run['seconds']
+        record['last_seconds'] = run['seconds']
+        if run['peak_bytes'] is not None:
+            record['peak_bytes'] = max(record['peak_bytes'] or 0, run['peak_bytes'])
+        if run['peak_bytes'] is None:
+            logger.debug('Stage %s took %.4f secs', name, run['seconds'])
+        else:
+            logger.debug('Stage %s took %.4f secs, peak memory %d bytes', name, run['seconds'], run['peak_bytes'])
+        self._notify('stage', name, dict(record))
+
+    def count(self, name, n=1):
+        """
+        Adds n to counter name
+        """
+        self.counters[name] += n
+        self._notify('counter', name, n)
+
+    def reset(self):
+        """
+        Drops all recorded timings and counters, hooks are kept
+        """
+        self.stages = {}
+        self.counters = Counter()
+
+    def as_dict(self):
+        """
+        Returns the stage records and counters as plain dictionaries, e.g. to log or serialize them
+
+        >>> metrics = Metrics()
+        >>> metrics.count('summaries_computed', 2)
+        >>> metrics.as_dict()
+        {'stages': {}, 'counters': {'summaries_computed': 2}}
+        """
+        return {'stages': {name: dict(record) for name, record in self.stages.items()}, 'counters': dict(self.counters)}
+
+    def __repr__(self):
+        stages = ', '.join(f"{name}={record['seconds']:.3f}s" for name, record in self.stages.items())
+        counters = ', '.join(f'{name}={value}' for name, value in self.counters.items())
+        return f'Metrics(stages: {stages or "-"}; counters: {counters or "-"})'
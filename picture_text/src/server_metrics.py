@@ -0,0 +1,112 @@
+"""
+Prometheus metrics of the Dash server: latency and response size of every callback, measured around Dash's
+callback route so no callback needs changing, and collection load times. instrument(app) adds them and a
+/metrics route to the app's Flask server. The hot path only reads the already parsed request body and the
+response length.
+
+Under gunicorn every worker keeps its own values. Set PROMETHEUS_MULTIPROC_DIR (see gunicorn_config.py) so
+/metrics reports all workers together. prometheus_client is optional; without it instrument only logs a warning
+"""
+import logging
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# Callbacks range from cached card pages (milliseconds) to building a collection on a cold start (tens of seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+if prometheus_client is not None:
+    CALLBACK_SECONDS = prometheus_client.Histogram('vst_callback_seconds', 'Latency of Dash callback requests',
+                                                ['callback', 'status'], buckets=LATENCY_BUCKETS)
+    CALLBACK_BYTES = prometheus_client.Histogram('vst_callback_response_bytes', 'Size of Dash callback responses',
+                                                ['callback'], buckets=SIZE_BUCKETS)
+    COLLECTION_LOAD_SECONDS = prometheus_client.Histogram('vst_collection_load_seconds', 'Time to load a collection',
+                                                ['collection'], buckets=LATENCY_BUCKETS)
+
+def callback_name(app, output):
+    """
+    Name of the function serving a callback output, outputs that are not registered callbacks are reported as 'unknown'
+    so request bodies cannot create new label values
+
+    >>> class App():
+    ...     callback_map = {'page-content.children': {'callback': callback_name}}
+    >>> callback_name(App(), 'page-content.children'), callback_name(App(), 'made-up.children')
+    ('callback_name', 'unknown')
+    """
+    entry = app.callback_map.get(output)
+    if entry is None:
+        return 'unknown'
+    return getattr(entry.get('callback'), '__name__', output)
+
+def timed_loader(loader):
+    """
+    Wraps a collection loader of the form collection = loader(name) to record its load time per collection
+    """
+    if prometheus_client is None:
+        return loader
+    def load(name):
+        with COLLECTION_LOAD_SECONDS.labels(collection=name).time():
+            return loader(name)
+    return load
+
+def metrics_registry():
+    """
+    Registry to expose, aggregating all worker processes when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
+
+def instrument(app, route='/metrics'):
+    """
+    Records latency and response size of every callback of a Dash app and serves them at route
+
+    Args:
+        app (Dash): the app, its Flask server gets the hooks and route
+        route (string, optional): path of the Prometheus text endpoint, defaults to '/metrics'
+    """
+    if prometheus_client is None:
+        logger.warning('prometheus_client is not installed, %s is not served', route)
+        return
+    import flask
+    server = app.server
+    callback_path = app.config.routes_pathname_prefix + '_dash-update-component'
+    names = {}
+
+    @server.before_request
+    def _start_timer():
+        if flask.request.path == callback_path:
+            flask.g.callback_t0 = time.perf_counter()
+
+    @server.after_request
+    def _observe(response):
+        t0 = flask.g.pop('callback_t0', None)
+        if t0 is not None:
+            body = flask.request.get_json(silent=True) or {}
+            output = body.get('output', '')
+            name = names.get(output)
+            if name is None:
+                name = callback_name(app, output)
+                # Only registered outputs are remembered, the callback map fills on the first request
+                if name != 'unknown':
+                    names[output] = name
+            CALLBACK_SECONDS.labels(callback=name, status=str(response.status_code)).observe(time.perf_counter() - t0)
+            size = response.calculate_content_length()
+            if size is not None:
+                CALLBACK_BYTES.labels(callback=name).observe(size)
+        return response
+
+    @server.route(route)
+    def _metrics():
+        return flask.Response(prometheus_client.generate_latest(metrics_registry()),
+                              content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,328 @@
+"""
+Batched cluster summaries computed over a shared HACTree. Every node's members form a contiguous
+slice of the tree's leaf ordering, so after reordering the embeddings once, a node's centroid and
+the similarity of each member to it are plain matrix operations on a view, without per-node copies.
+
+Two summarizer protocols are supported:
+    - per node: summary, summary_quality = summarizer(list_text, list_embeddings), called once per node
+    - batched: labels, scores = summarizer(nodes), called once with a TreeNodes object describing all
+      nodes; mark such functions with the batched_summarizer decorator
+Expensive per node summarizers can be run across a thread or process pool with parallel_summarizer
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+import multiprocessing
+import time
+import numpy as np
+
+class TreeNodes():
+    """
+    Input of batched summarizers: the shared embedding matrix and text array plus, for every node,
+    the range of its members within leaf_order. Nothing is copied per node
+    """
+    def __init__(self, embeddings, txt, leaf_order, starts, ends, node_ids):
+        """
+        Args:
+            embeddings (array): N x d embedding matrix, row i belongs to document i
+            txt (list or array): N strings, one per document
+            leaf_order (array): document indices ordered so that each node's members are contiguous
+            starts (array): start of each node's members in leaf_order
+            ends (array): end (exclusive) of each node's members in leaf_order
+            node_ids (array): id of each node
+        """
+        self.embeddings = embeddings
+        self.txt = txt
+        self.leaf_order = leaf_order
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+
+    @classmethod
+    def from_tree(cls, tree, embeddings, txt, node_ids):
+        """
+        Describes node_ids of a HACTree
+
+        Args:
+            tree (HACTree): tree the nodes belong to
+            embeddings (list or array): N x d embeddings, row i belongs to leaf i of the tree
+            txt (list): N strings, one per leaf
+            node_ids (list): ids of the nodes
+        Returns:
+            TreeNodes
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        starts = tree.leaf_start[node_ids]
+        return cls(np.asarray(embeddings), txt, tree.leaf_order, starts, starts + tree.count[node_ids], node_ids)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def members(self, i):
+        """
+        Returns the document indices of the i-th node as a view into leaf_order
+        """
+        return self.leaf_order[self.starts[i]:self.ends[i]]
+
+    def depths(self):
+        """
+        Returns the depth of each node, i.e. the number of other nodes in the batch containing it
+
+        >>> TreeNodes(None, None, np.arange(4), [0, 0, 2, 2, 3], [4, 2, 4, 3, 4], [6, 4, 5, 2, 3]).depths()
+        array([0, 1, 1, 2, 2])
+        """
+        # Sorting by start then by decreasing end visits every node right after the nodes containing it
+        order = np.lexsort((-self.ends, self.starts))
+        depths = np.zeros(len(self), dtype=np.int64)
+        open_ends = []
+        for i in order:
+            while open_ends and open_ends[-1] <= self.starts[i]:
+                open_ends.pop()
+            depths[i] = len(open_ends)
+            open_ends.append(self.ends[i])
+        return depths
+
+    def subset(self, positions):
+        """
+        Returns a TreeNodes restricted to the nodes at the given positions
+        """
+        return TreeNodes(self.embeddings, self.txt, self.leaf_order,
+                            self.starts[positions], self.ends[positions], self.node_ids[positions])
+
+def batched_summarizer(func):
+    """
+    Marks func as a batched summarizer of the form labels, scores = func(nodes) with nodes a TreeNodes
+    """
+    func.batched = True
+    return func
+
+def is_batched(summarizer):
+    return getattr(summarizer, 'batched', False)
+
+def per_node_summarizer(summarizer):
+    """
+    Adapts a per node summarizer of the form summary, summary_quality = summarizer(list_text, list_embeddings)
+    to the batched protocol. Members are passed in ascending document order as before
+
+    Args:
+        summarizer (object): per node summarizer
+    Returns:
+        batched summarizer
+
+    >>> nodes = TreeNodes(np.array([[1.], [2.], [3.]]), ['a', 'b', 'c'], np.array([2, 0, 1]), [0, 1], [3, 3], [4, 3])
+    >>> per_node_summarizer(lambda t, e: (' '.join(map(str, t)), float(np.sum(e))))(nodes)
+    (['a b c', 'a b'], array([6., 3.]))
+    """
+    @batched_summarizer
+    def adapted(nodes):
+        labels = []
+        scores = np.empty(len(nodes), dtype=np.float64)
+        for i in range(len(nodes)):
+            members = np.sort(nodes.members(i))
+            label, scores[i] = summarizer([np.array(nodes.txt[m]) for m in members],
+                                            list(nodes.embeddings[members]))
+            labels.append(label)
+        return labels, scores
+    return adapted
+
+def run_summarizer(summarizer, nodes):
+    """
+    Runs a summarizer of either protocol over nodes
+
+    Args:
+        summarizer (object): batched or per node summarizer
+        nodes (TreeNodes): nodes to summarize
+    Returns:
+        labels (list): summary per node
+        scores (array): score per node
+    """
+    if not is_batched(summarizer):
+        summarizer = per_node_summarizer(summarizer)
+    labels, scores = summarizer(nodes)
+    assert(len(labels)==len(nodes) and len(scores)==len(nodes))
+    return list(labels), np.asarray(scores, dtype=np.float64)
+
+@batched_summarizer
+def centroid_summarizer(nodes):
+    """
+    Vectorized equivalent of PictureText.cluster_summary_simple for many nodes at once: the summary of a
+    node is the member closest (by cosine similarity) to the node's average embedding and its score is the
+    average of 0.5 * (1 + cosine similarity) of all members to that average. Ties go to the lowest document index
+
+    Args:
+        nodes (TreeNodes): nodes to summarize
+    Returns:
+        labels (list): summary string per node
+        scores (array): average centroid similarity per node
+    """
+    X = np.asarray(nodes.embeddings, dtype=np.float64)
+    leaf_order = nodes.leaf_order
+    # Reorder once so every node is a contiguous slice, unit rows give cosine similarities by dot product
+    X_ordered = X[leaf_order]
+    norms = np.linalg.norm(X_ordered, axis=1, keepdims=True)
+    X_unit = np.divide(X_ordered, norms, out=np.zeros_like(X_ordered), where=norms > 0)
+
+    labels = []
+    scores = np.empty(len(nodes), dtype=np.float64)
+    for i in range(len(nodes)):
+        members = slice(int(nodes.starts[i]), int(nodes.ends[i]))
+        centroid = X_ordered[members].mean(axis=0)
+        centroid_norm = np.linalg.norm(centroid)
+        if centroid_norm > 0:
+            rank = 0.5 * (1 + X_unit[members] @ (centroid / centroid_norm))
+        else:
+            rank = np.full(members.stop - members.start, 0.5)
+        best = rank.max()
+        leaves = leaf_order[members]
+        labels.append(str(nodes.txt[int(leaves[rank == best].min())]))
+        scores[i] = rank.mean()
+    return labels, scores
+
+def centroid_summaries(tree, embeddings, txt, node_ids):
+    """
+    Runs centroid_summarizer over node_ids of a HACTree
+
+    Args:
+        tree (HACTree): tree the nodes belong to
+        embeddings (list or array): N x d embeddings, row i belongs to leaf i of the tree
+        txt (list): N strings, one per leaf
+        node_ids (list): ids of the nodes to summarize
+    Returns:
+        labels (list): summary string per node
+        scores (array): average centroid similarity per node
+
+    >>> import fastcluster
+    >>> from picture_text.src.hac_tools import HACTree
+    >>> X = [[1, 2], [4, 5], [10, 0], [9, 1]]
+    >>> tree = HACTree(fastcluster.linkage(X, method='ward'))
+    >>> labels, scores = centroid_summaries(tree, X, ['txt1', 'txt2', 'txt3', 'txt4'], [4, 5, 6])
+    >>> labels
+    ['txt3', 'txt2', 'txt4']
+    >>> scores.round(6)
+    array([0.999233, 0.99657 , 0.934145])
+    """
+    return centroid_summarizer(TreeNodes.from_tree(tree, embeddings, txt, node_ids))
+
+# Shared state of process pool workers, see _init_summary_worker
+_worker_state = {}
+
+def _init_summary_worker(shm_name, shape, dtype, txt, summarizer, started):
+    """
+    Process pool initializer: attaches to the embeddings in shared memory and keeps text, summarizer and
+    the shared array of node start times
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state['shm'] = shm
+    _worker_state['embeddings'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker_state['txt'] = txt
+    _worker_state['summarizer'] = summarizer
+    _worker_state['started'] = started
+
+def _summarize_members(i, members, embeddings=None, txt=None, summarizer=None, started=None):
+    """
+    Runs a per node summarizer on the i-th node and records when it started, falls back to the process worker
+    state when no arguments are given
+    """
+    if embeddings is None:
+        embeddings, txt, summarizer = _worker_state['embeddings'], _worker_state['txt'], _worker_state['summarizer']
+        started = _worker_state['started']
+    # time.monotonic is one system wide clock, so start times written by process workers compare with the parent's
+    started[i] = time.monotonic()
+    return summarizer([np.array(txt[m]) for m in members], list(embeddings[members]))
+
+def parallel_summarizer(summarizer, workers=4, executor='thread', timeout=None, timeout_label='(timed out)',
+                        start_method='spawn', total_timeout=None, poll_interval=0.05):
+    """
+    Runs a per node summarizer across a thread or process pool. Nodes are scheduled by depth so the top levels
+    of the treemap are ready first, results always come back in node order. Process workers read the
+    embeddings from shared memory, so they are not pickled per node
+
+    Args:
+        summarizer (object): per node summarizer of the form summary, summary_quality = summarizer(list_text, list_embeddings),
+            needs to be picklable (a module level function) for the process executor
+        workers (int, optional): pool size, defaults to 4
+        executor (string, optional): 'thread' (summarizers releasing the GIL, e.g. remote calls) or 'process', defaults to 'thread'
+        timeout (float, optional): seconds a single node may run, counted from when a worker starts it, defaults to None
+            (no timeout). Nodes over time are abandoned rather than cancelled: they keep their worker busy until they
+            return and their result is dropped. Once every worker is held by an abandoned node the nodes still
+            queued are given up as well
+        timeout_label (string, optional): summary used for nodes that timed out, their score is nan, defaults to '(timed out)'
+        start_method (string, optional): multiprocessing start method of the process executor, defaults to 'spawn'
+        total_timeout (float, optional): seconds to wait for all nodes together, counted from submission, defaults to None
+        poll_interval (float, optional): seconds between checks of the running nodes' clocks, defaults to 0.05
+    Returns:
+        batched summarizer
+
+    >>> import time
+    >>> def slow_summarizer(txt, embeddings):
+    ...     time.sleep(0.4 * len(txt))
+    ...     return str(txt[0]), len(txt)
+    >>> nodes = TreeNodes(np.zeros((3, 1)), ['a', 'b', 'c'], np.arange(3), [0, 0, 2], [3, 2, 3], [4, 3, 2])
+    >>> t0 = time.perf_counter()
+    >>> parallel_summarizer(slow_summarizer, workers=3, timeout=1.0)(nodes)
+    (['(timed out)', 'a', 'c'], array([nan,  2.,  1.]))
+    >>> time.perf_counter() - t0 < 1.2
+    True
+
+    Queued nodes are not charged for the time spent waiting for a worker
+
+    >>> nodes = TreeNodes(np.zeros((10, 1)), list('abcdefghij'), np.arange(10), range(10), range(1, 11), range(10))
+    >>> labels, scores = parallel_summarizer(slow_summarizer, workers=2, timeout=1.0)(nodes)
+    >>> ''.join(labels)
+    'abcdefghij'
+    >>> labels, scores = parallel_summarizer(slow_summarizer, workers=2, timeout=1.0, total_timeout=1.0)(nodes)
+    >>> labels.count('(timed out)')
+    6
+    """
+    if executor not in ['thread', 'process']:
+        raise ValueError(f"Unknown executor {executor}, use 'thread' or 'process'")
+
+    @batched_summarizer
+    def parallel(nodes):
+        labels = [timeout_label] * len(nodes)
+        scores = np.full(len(nodes), np.nan)
+        order = np.argsort(nodes.depths(), kind='stable')
+        members = [np.sort(nodes.members(i)) for i in range(len(nodes))]
+        shm = None
+        if executor == 'thread':
+            started = np.full(len(nodes), np.nan)
+            pool = ThreadPoolExecutor(max_workers=workers)
+            submit = lambda i: pool.submit(_summarize_members, i, members[i], nodes.embeddings, nodes.txt, summarizer, started)
+        else:
+            context = multiprocessing.get_context(start_method)
+            started = context.Array('d', [np.nan] * len(nodes), lock=False)
+            embeddings = np.ascontiguousarray(nodes.embeddings)
+            shm = shared_memory.SharedMemory(create=True, size=max(embeddings.nbytes, 1))
+            np.ndarray(embeddings.shape, dtype=embeddings.dtype, buffer=shm.buf)[:] = embeddings
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                        initializer=_init_summary_worker,
+                        initargs=(shm.name, embeddings.shape, embeddings.dtype, list(nodes.txt), summarizer, started))
+            submit = lambda i: pool.submit(_summarize_members, i, members[i])
+        try:
+            deadline = None if total_timeout is None else time.monotonic() + total_timeout
+            futures = {submit(i): i for i in order}
+            pending, abandoned = set(futures), set()
+            while pending:
+                done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    labels[futures[future]], scores[futures[future]] = future.result()
+                now = time.monotonic()
+                if deadline is not None and now > deadline:
+                    expired = set(pending)
+                elif timeout is not None:
+                    expired = {f for f in pending if now - started[futures[f]] > timeout}
+                    abandoned |= expired
+                    # Queued nodes cannot start while every worker is held by a node over time
+                    if sum(not f.done() for f in abandoned) >= workers:
+                        expired = set(pending)
+                else:
+                    expired = set()
+                for future in expired:
+                    future.cancel()
+                pending -= expired
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        return labels, scores
+    return parallel
@@ -59,7 +59,9 @@ def build_tree_map(df,
                     'tag_color':'tag_color'
                     },
                 value_name = '# docs',
-                color_name = 'Avg. Similarity'):
+                color_name = 'Avg. Similarity',
+                average_score = None,
+                maxdepth = None):
     """
     Can demonstrate a dataframe as a hierarchical treemap and choose
     the depth showed at any time.
@@ -70,15 +72,19 @@ def build_tree_map(df,
 
     Args:
         df (dataframe or list of dataframes): Mandatory columns must match spec in column_nm. Need columns for: id, label, parent, value, color
-        average_score (float, optional): Score used as midpoint for plot colors, defaults to 0.5
-        maxdepth (int, optional): Number of levels of hierarchy to show, min 2, defaults to None
         column_nm (dict, optional): Set of column mappings for the mandatory tree map fields. Need columns for: id, label, parent, value, color
         value_name (string, optional): Hovertext label for 'value' values from dataframe, defaults to 'Label'
         color_name (string, optional): Hovertext label for 'color' values from dataframe, defaults to 'Color'
+        average_score (float, optional): Score used as midpoint for plot colors when df has no tag_color column, defaults to None
+        maxdepth (int, optional): Number of levels of hierarchy to show, min 2, defaults to None
 
     Returns:
         Interactive plotly treemap
     """
+    if column_nm['tag_color'] in df:
+        marker = dict(colors = df[column_nm['tag_color']])
+    else:
+        marker = dict(colors = df[column_nm['color']], colorscale='RdBu', cmid=average_score)
 
     fig = go.Figure(go.Treemap(
         ids=df[column_nm['id']],
@@ -91,7 +97,8 @@ def build_tree_map(df,
         #    colorscale='RdBu',
         #    cmid=average_score)
         #),"""
-        marker=dict(colors = df[column_nm['tag_color']]),
+        marker=marker,
+        maxdepth=maxdepth,
         hovertemplate='<b>%{label} </b> <br> '+value_name+': %{value}<br>'+color_name+': %{color:.2f}',
         name=''
         ))
@@ -100,6 +107,92 @@ def build_tree_map(df,
     #uniformtext_minsize=12, uniformtext_mode='show')
     return fig
 
+def build_node_index(df, column_nm = {'id':'id', 'parent':'parent', 'value':'value'}):
+    """
+    Indexes a treemap dataframe by node id (as string, the form treemap clicks report ids in)
+
+    Args:
+        df (dataframe): treemap dataframe, e.g. the output of hac_to_treemap
+        column_nm (dict, optional): column mappings for id, parent and value
+    Returns:
+        dictionary with 'position' (id to row position) and 'children' (parent id to row positions of its children, biggest first)
+
+    >>> df = pd.DataFrame({'id': [5, 4, 2, 3], 'parent': ['Full', 'Full', 5, 5], 'value': [2, 1, 1, 1]})
+    >>> build_node_index(df)
+    {'position': {'5': 0, '4': 1, '2': 2, '3': 3}, 'children': {'Full': [0, 1], '5': [2, 3]}}
+    """
+    ids = df[column_nm['id']].astype(str).tolist()
+    values = df[column_nm['value']].tolist()
+    children = {}
+    for pos, parent in enumerate(df[column_nm['parent']].astype(str)):
+        children.setdefault(parent, []).append(pos)
+    for parent in children:
+        children[parent].sort(key=lambda pos: -values[pos])
+    return {'position': dict(zip(ids, range(len(ids)))), 'children': children}
+
+def subtree_rows(df, node_index, root='Full', depth=2, max_nodes=500, column_nm = {'id':'id'}):
+    """
+    Row positions of root and of the nodes at most depth levels below it, bounded by max_nodes.
+    Each level is added biggest nodes first, so a cut keeps the largest clusters
+
+    Args:
+        df (dataframe): treemap dataframe
+        node_index (dict): output of build_node_index for df
+        root (string, optional): id of the subtree root, defaults to 'Full', the parent of the top layer (not a row itself)
+        depth (int, optional): number of levels below root, defaults to 2
+        max_nodes (int, optional): maximal number of rows returned, defaults to 500
+    Returns:
+        list of row positions
+
+    >>> df = pd.DataFrame({'id': [5, 4, 2, 3], 'parent': ['Full', 'Full', 5, 5], 'value': [2, 1, 1, 1]})
+    >>> subtree_rows(df, build_node_index(df)), subtree_rows(df, build_node_index(df), root='5', depth=1)
+    ([0, 1, 2, 3], [0, 2, 3])
+    >>> subtree_rows(df, build_node_index(df), max_nodes=3)
+    [0, 1, 2]
+    """
+    root = str(root)
+    rows = [node_index['position'][root]] if root in node_index['position'] else []
+    level = [root]
+    ids = df[column_nm['id']].astype(str).tolist()
+    for _ in range(depth):
+        below = [pos for node in level for pos in node_index['children'].get(node, [])]
+        below = below[:max(0, max_nodes - len(rows))]
+        if not below:
+            break
+        rows += below
+        level = [ids[pos] for pos in below]
+    return rows
+
+def build_drilldown_tree_map(df, node_index, root='Full', depth=2, max_nodes=500,
+                column_nm = {
+                    'id':'id',
+                    'label':'labels',
+                    'parent':'parent',
+                    'value':'value',
+                    'color':'color',
+                    'tag_color':'tag_color'
+                    },
+                **kwargs):
+    """
+    Treemap of only the subtree under root, see subtree_rows. Used for drill-down views where the server sends
+    the next levels when a node is clicked, so the figure size is bounded by max_nodes whatever the size of df
+
+    Args:
+        df (dataframe): treemap dataframe
+        node_index (dict): output of build_node_index for df
+        root (string, optional): id of the node to show, defaults to 'Full' (the top layers)
+        depth (int, optional): number of levels below root to show, defaults to 2
+        max_nodes (int, optional): maximal number of nodes in the figure, defaults to 500
+        column_nm (dict, optional): Set of column mappings for the mandatory tree map fields
+        kwargs: passed on to build_tree_map
+    Returns:
+        Interactive plotly treemap
+    """
+    sub = df.iloc[subtree_rows(df, node_index, root=root, depth=depth, max_nodes=max_nodes)].copy()
+    # The subtree root becomes the root of the figure
+    sub[column_nm['parent']] = sub[column_nm['parent']].where(sub[column_nm['id']].astype(str) != str(root), '')
+    return build_tree_map(sub, column_nm=column_nm, **kwargs)
+
 def build_sunburst(df, 
                 color_discrete_map = {'(?)':'black', },
                 column_color_choice = 'color',